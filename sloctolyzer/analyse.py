@@ -1,20 +1,88 @@
 import os
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
-import torch
 import sys
 import cv2
-import scipy
 import copy
 from PIL import Image, ImageOps
-from eyepy.core import utils as eyepy_utils
-from eyepy.io.he import vol_reader
-from skimage import segmentation, morphology
 from pathlib import Path, WindowsPath, PosixPath
 from sloctolyzer import utils
 from sloctolyzer.measure import slo_measurement
-from sloctolyzer.segment import slo_inference, avo_inference, fov_inference
+from sloctolyzer.segment.postprocess import OpticDisc
+
+# PyTorch and the segmentation models, matplotlib and .vol file readers are only imported
+# when first needed, so that analysing already segmented images starts quickly
+
+def _crop_infobar(slo):
+    """Remove the 100-row info bar at the bottom of image files saved from HEYEX"""
+    if slo.shape[0]==1636 or slo.shape[0]==868:
+        slo = slo[:slo.shape[0]-100]
+    return slo
+
+
+def load_slo(path, verbose=True):
+    """
+    Load an SLO image from an image or .vol file, cropping any HEYEX info bar.
+
+    Returns the SLO array, metadata stored in the file (only populated for .vol files,
+    including eye, scale and location) and a list of logging messages.
+    """
+    logging_list = []
+    metadata = {}
+
+    # check if vol file, otherwise is regular image file
+    ftype = str(path).split('.')[-1]
+    if ftype.lower() == 'vol':
+        slo, meta, log = utils.load_volfile(path, verbose=verbose, logging=[])
+        metadata = copy.deepcopy(meta)
+        logging_list.extend(log)
+    else:
+        slo = np.array(ImageOps.grayscale(Image.open(path)))
+
+    return _crop_infobar(slo), metadata, logging_list
+
+
+def segment_batch(slos, locations=None, slo_model=None, avo_model=None, fov_model=None, batch_size=16, fovea_map=True):
+    """
+    Segment a stack of SLO images, running each model once over the whole stack.
+
+    Inputs:
+    -------------------
+    slos (list) : SLO arrays as returned by load_slo, of any mix of resolutions.
+
+    locations (list) : Location per SLO ('Macula', 'Optic disc' or None), used for optic disc post-processing.
+
+    slo_model, avo_model, fov_model : binary, artery-vein-optic disc, and fovea detection models.
+
+    batch_size (int) : Number of images per forward pass.
+
+    fovea_map (bool) : Whether the fovea map is needed, i.e. to be saved. If not, its 'fovea_map' is None.
+
+    Returns a list of per-image prediction dictionaries to pass to analyse(..., predictions=...).
+    """
+    from sloctolyzer.segment import slo_inference, avo_inference, fov_inference
+    from sloctolyzer.segment.preprocess import prepare_img
+    if slo_model is None:
+        slo_model = slo_inference.SLOSegmenter()
+    if fov_model is None:
+        fov_model = fov_inference.FOVSegmenter()
+    if avo_model is None:
+        avo_model = avo_inference.AVOSegmenter()
+
+    # Decode and resize each SLO once, shared across all three models
+    slo_inputs = [prepare_img(_crop_infobar(slo)) for slo in slos]
+    vbinmaps = slo_model.predict_batch(slo_inputs, batch_size=batch_size)
+    fmasks, foveas = fov_model.predict_batch(slo_inputs, batch_size=batch_size, return_map=fovea_map)
+    avimouts, opticdiscs = avo_model.predict_batch(slo_inputs, location_list=locations, batch_size=batch_size,
+                                                     return_opticdisc=True)
+
+    predictions = []
+    for output in zip(vbinmaps, fmasks, foveas, avimouts, opticdiscs):
+        keys = ['binary_map', 'fovea_map', 'fovea', 'avod_map', 'opticdisc']
+        predictions.append(dict(zip(keys, output)))
+
+    return predictions
+
 
 def analyse(path, 
             save_path=None, 
@@ -30,6 +98,8 @@ def analyse(path,
             compute_metrics=True,
             verbose=True,
             segmentation_dict={},
+            preloaded=None,
+            predictions=None,
             demo_return=False):
     """
     Inner function to analyse an individual IR-SLO img, given options for scaling/location/eye.
@@ -59,6 +129,10 @@ def analyse(path,
 
     segmentation_dict (dict) : Dictionaries with new segmentation to recompute measurements. By default left empty UNLESS
                                correcting manual segmentations.
+
+    preloaded (tuple) : Output of load_slo(path) if the file has already been loaded, to avoid reading it twice.
+
+    predictions (dict) : Per-image output of segment_batch. If specified, the models are not run again.
     """
     # Initialise list of messages to save
     logging_list = []
@@ -68,16 +142,15 @@ def analyse(path,
     if isinstance(path, (str, WindowsPath, PosixPath)):
 
         # check if vol file, otherwise is regular image file
-        ftype = str(path).split('.')[-1]
-        if ftype.lower() == 'vol':
-            slo, meta, log = utils.load_volfile(path, verbose=verbose, logging=[])
+        if preloaded is None:
+            preloaded = load_slo(path, verbose=verbose)
+        slo, meta, log = preloaded
+        if len(meta) > 0:
             eye = meta['eye']
             scale = meta['scale']
             location = meta['location']
             metadata = copy.deepcopy(meta)
-            logging_list.extend(log)
-        else:
-            slo = np.array(ImageOps.grayscale(Image.open(path)))
+        logging_list.extend(log)
 
     elif isinstance(path, np.ndarray):
         slo = path.copy()
@@ -88,12 +161,10 @@ def analyse(path,
         if verbose:
             print(msg)
         return
-    img_shape = slo.shape
 
     # accuounting for image files saved from HEYEX with info bar at bottom of image which is 100 rows.
-    if slo.shape[0]==1636 or slo.shape[0]==868:
-        slo = slo[:img_shape[0]-100]
-        img_shape = slo.shape
+    slo = _crop_infobar(slo)
+    img_shape = slo.shape
     _, N = img_shape
 
     # Collect metadata for recomputing measurements when a manual annotation is provided
@@ -109,9 +180,10 @@ def analyse(path,
         slo_avimout = segmentation_dict['avod_map']
         slo_vbinmap = segmentation_dict['binary_map']
         od_mask = slo_avimout[...,1]
-        od_centre = avo_inference._get_od_centre(od_mask)
+        opticdisc = OpticDisc(od_mask)
+        od_centre = opticdisc.centre
         if location == 'Optic disc':
-            od_radius, od_boundary = utils._process_opticdisc(od_mask)
+            od_radius = opticdisc.radius
             metadata['optic_disc_x'] = od_centre[0]
             metadata['optic_disc_y'] = od_centre[1]
             metadata['optic_disc_radius_px'] = od_radius
@@ -188,45 +260,64 @@ def analyse(path,
         if verbose:
             print(msg)
     
-        # Forcing model instantiation if unspecified
-        # SLO segmentation models
-        if slo_model is None or type(slo_model) != slo_inference.SLOSegmenter:
-            msg = "Loading models..."
+        if predictions is None:
+            from sloctolyzer.segment import slo_inference, avo_inference, fov_inference
+            from sloctolyzer.segment.preprocess import prepare_img
+
+            # Forcing model instantiation if unspecified
+            # SLO segmentation models
+            if not isinstance(slo_model, slo_inference.SLOSegmenter):
+                msg = "Loading models..."
+                logging_list.append(msg)
+                if verbose:
+                    print(msg)
+                slo_model = slo_inference.SLOSegmenter()
+             # SLO segmentation models
+            if not isinstance(fov_model, fov_inference.FOVSegmenter):
+                fov_model = fov_inference.FOVSegmenter()
+            # AVO segmentation models
+            if not isinstance(avo_model, avo_inference.AVOSegmenter):
+                avo_model = avo_inference.AVOSegmenter()
+
+            # Decode and resize the SLO once, shared across all three models
+            slo_input = prepare_img(slo)
+
+            # binary vessel detection
+            msg = "    Segmenting binary vessels from SLO image."
             logging_list.append(msg)
             if verbose:
                 print(msg)
-            slo_model = slo_inference.SLOSegmenter()
-         # SLO segmentation models
-        if fov_model is None or type(fov_model) != fov_inference.FOVSegmenter:
-            fov_model = fov_inference.FOVSegmenter()
-        # AVO segmentation models
-        if avo_model is None or type(avo_model) != avo_inference.AVOSegmenter:
-            avo_model = avo_inference.AVOSegmenter()
-
-        # binary vessel detection
-        msg = "    Segmenting binary vessels from SLO image."
-        logging_list.append(msg)
-        if verbose:
-            print(msg)
-        slo_vbinmap = slo_model.predict_img(slo)
+            slo_vbinmap = slo_model.predict_img(slo_input)
+
+            # fovea detection
+            msg = "    Segmenting fovea from SLO image."
+            logging_list.append(msg)
+            if verbose:
+                print(msg)
+            fmask, fovea = fov_model.predict_img(slo_input, return_map=save_images)
+
+            # artery-vein-optic disc detection, using binary vessel detector as original reference
+            # We also reassigh the binary vessel map as artery+vein maps
+            msg = "    Segmenting artery-vein vessels and optic disc from SLO image."
+            logging_list.append(msg)
+            if verbose:
+                print(msg)
+            slo_avimout, opticdisc = avo_model.predict_img(slo_input, location=location, return_opticdisc=True)#, slo_vbinmap)
+
+        # Segmentations already computed alongside other images in segment_batch()
+        else:
+            msg = "    Using binary vessel, fovea and artery-vein-optic disc segmentations from batched inference."
+            logging_list.append(msg)
+            if verbose:
+                print(msg)
+            slo_vbinmap = predictions['binary_map']
+            fmask, fovea = predictions['fovea_map'], predictions['fovea']
+            slo_avimout, opticdisc = predictions['avod_map'], predictions['opticdisc']
 
-        # fovea detection
-        msg = "    Segmenting fovea from SLO image."
-        logging_list.append(msg)
-        if verbose:
-            print(msg)
-        fmask, fovea = fov_model.predict_img(slo)
         if save_images:
             cv2.imwrite(os.path.join(save_path,f"{fname}_slo_fovea_map.png"), 
                         (255*fmask).astype(np.uint8))
-
-        # artery-vein-optic disc detection, using binary vessel detector as original reference
-        # We also reassigh the binary vessel map as artery+vein maps
-        msg = "    Segmenting artery-vein vessels and optic disc from SLO image."
-        logging_list.append(msg)
-        if verbose:
-            print(msg)
-        slo_avimout, od_centre = avo_model.predict_img(slo, location=location)#, slo_vbinmap)
+        od_centre = opticdisc.centre
         if od_centre is None:
             msg = 'WARNING: Optic disc not detected. Please check image.'
             logging_list.append(msg)
@@ -326,7 +417,7 @@ def analyse(path,
     # store optic disc centre,
     # The latter is only stored for for an optic disc-centred scan
     # macular-centred SLO do not show the optic disc entirel
-    od_radius, od_boundary = utils._process_opticdisc(od_mask)
+    od_radius = opticdisc.radius
     if location == "Optic disc":
         metadata["optic_disc_x"] = od_centre[0]
         metadata["optic_disc_y"] = od_centre[1]
@@ -449,6 +540,8 @@ def analyse(path,
 
         # Plot the segmentations superimposed onto the SLO
         if save_images or collate_segmentations:
+            import matplotlib.pyplot as plt
+            from skimage import segmentation, morphology
             
             # binary vessel mask - purple
             slo_vcmap = utils.generate_imgmask(slo_vbinmap, None, 1)
@@ -460,7 +553,7 @@ def analyse(path,
             slo_av_cmap[...,1] = 0
             stacked_cmap = np.hstack([np.zeros_like(slo_vcmap), slo_vcmap, slo_av_cmap])
             if od_mask.sum() != 0:
-                od_coords = avo_inference._fit_ellipse((255*od_mask).astype(np.uint8), get_contours=True)[:,0]
+                od_coords = opticdisc.contour
                 od_coords = od_coords[(od_coords[:,0] > 0) & (od_coords[:,0] < N-1)]
                 od_coords = od_coords[(od_coords[:,1] > 0) & (od_coords[:,1] < N-1)]
             # od_cmap = utils.generate_imgmask(np.hstack(2*[np.zeros_like(od_mask)]+[od_boundary]), None, 1)
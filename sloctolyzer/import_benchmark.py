@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+SCRIPT_PATH = os.path.realpath(os.path.dirname(__file__))
+PACKAGE_PATH = os.path.dirname(SCRIPT_PATH)
+
+# Modules timed, with their startup budget in seconds on a typical workstation and the
+# heavy dependencies they must not import until they are needed
+BUDGETS = {
+    'sloctolyzer.analyse': (2.0, ['torch', 'torchvision', 'matplotlib', 'sklearn', 'SimpleITK', 'eyepy']),
+    'sloctolyzer.utils': (2.0, ['torch', 'matplotlib', 'sklearn', 'SimpleITK', 'eyepy']),
+    'sloctolyzer.segment.postprocess': (1.0, ['torch', 'pandas', 'matplotlib']),
+    'main': (2.0, ['torch', 'torchvision', 'matplotlib', 'sklearn', 'SimpleITK', 'eyepy']),
+}
+
+_TIMER = """
+import sys, time, json
+sys.path.insert(0, {package_path!r})
+sys.path.insert(0, {script_path!r})
+st = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - st
+print(json.dumps({{'time': elapsed, 'modules': sorted(m for m in sys.modules if '.' not in m)}}))
+"""
+
+
+def time_import(module, n_runs=3):
+    """
+    Import module in n_runs fresh interpreters, returning the fastest import time in seconds
+    and the top-level modules it loaded.
+    """
+    best = None
+    for _ in range(n_runs):
+        code = _TIMER.format(package_path=PACKAGE_PATH, script_path=SCRIPT_PATH, module=module)
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        if best is None or result['time'] < best['time']:
+            best = result
+    return best['time'], best['modules']
+
+
+def run_benchmark(budgets=BUDGETS, scale=1.0, n_runs=3, verbose=True):
+    """
+    Time importing each module against its budget, multiplied by scale for slower machines,
+    and check its heavy dependencies are not imported eagerly. Returns whether all passed.
+    """
+    passed = True
+    for module, (budget, forbidden) in budgets.items():
+        elapsed, modules = time_import(module, n_runs)
+        loaded = [m for m in forbidden if m in modules]
+        ok = (elapsed <= scale*budget) and (len(loaded) == 0)
+        passed &= ok
+        if verbose:
+            msg = f"{'PASS' if ok else 'FAIL'} {module}: {elapsed:.2f}s (budget {scale*budget:.2f}s)"
+            if len(loaded) > 0:
+                msg += f", eagerly imports {', '.join(loaded)}"
+            print(msg)
+
+    return passed
+
+
+# Once called from terminal
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check SLOctolyzer's modules import within their startup budget.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier of every budget, e.g. 2 for a slow machine.")
+    parser.add_argument("--n_runs", type=int, default=3, help="Number of fresh imports per module, the fastest is used.")
+    args = parser.parse_args()
+    assert run_benchmark(scale=args.scale, n_runs=args.n_runs), "Import time budget exceeded."
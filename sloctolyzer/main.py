@@ -11,23 +11,81 @@ sys.path.append(SCRIPT_PATH)
 sys.path.append(MODULE_PATH)
 sys.path.append(PACKAGE_PATH)
 
-import shutil
 import argparse
+import functools
 import time
-import pprint
-import cv2
 import numpy as np
-from tqdm import tqdm
 import pandas as pd
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path, PosixPath, WindowsPath
 import analyse
 from PIL import Image, ImageOps
 import utils
-from skimage import segmentation, morphology
-import matplotlib.pyplot as plt
-from segment import slo_inference, avo_inference, fov_inference
-from measure import slo_measurement
-import utils
+from sloctolyzer.prefetch import Prefetcher
+
+
+def _load_segmenter(name, prob_store=None, tier="full", fast_fovea=0):
+    """
+    Import PyTorch and construct the 'slo', 'avo' or 'fov' segmenter. Run on background threads
+    at startup, so importing PyTorch and reading the weights overlap file discovery.
+    """
+    from sloctolyzer.segment import slo_inference, avo_inference, fov_inference
+    if name == "slo":
+        return slo_inference.SLOSegmenter(prob_store=prob_store, tier=tier)
+    elif name == "avo":
+        return avo_inference.AVOSegmenter(prob_store=prob_store, tier=tier)
+    return fov_inference.FOVSegmenter(prob_store=prob_store, tier=tier,
+                                      fast_size=fov_inference.FAST_SIZE if fast_fovea else None)
+
+
+def _get_resolution(res_df, fname_type, verbose=True):
+    """Extract scale, location and eye for fname_type from the resolution file, if present"""
+    scale = None
+    location = None
+    eye = None
+    fname_res_loc = res_df[res_df.Filename == fname_type]
+    if fname_res_loc.shape[0] == 0:
+        if verbose:
+            fname = fname_type.split(".")[0]
+            print(f"\n\nCan't find information on {fname}. If fname_resolution_location.xlsx specified, check filename spelling?")
+            print(f"Falling back to default state of not using a scale and automatically detecting centering.")
+    else:
+        # extract scale and location. If unspecified, set to None
+        scale = fname_res_loc.iloc[0].Scale
+        if pd.isna(scale):
+            scale = None
+        location = fname_res_loc.iloc[0].Location
+        if pd.isna(location):
+            location = None
+        eye = fname_res_loc.iloc[0].Eye
+        if pd.isna(eye):
+            eye = None
+
+    return scale, location, eye
+
+
+def _segment_batch(paths, res_df, slosegmenter, avosegmenter, fovsegmenter, batch_size, fovea_map=True, prefetcher=None):
+    """
+    Load and segment a batch of not-yet-analysed files together, returning the
+    loaded SLO and predictions of each file, keyed by its filename. Files are collected
+    from prefetcher if specified.
+    """
+    fname_types = [os.path.split(path)[1] for path in paths]
+    loaded = [analyse.load_slo(path, verbose=False) if prefetcher is None else prefetcher.get(path) for path in paths]
+
+    # Location is needed for optic disc post-processing, which .vol files store themselves
+    locations = []
+    for fname_type, (_, meta, _) in zip(fname_types, loaded):
+        if 'location' in meta:
+            locations.append(meta['location'])
+        else:
+            locations.append(_get_resolution(res_df, fname_type, verbose=False)[1])
+
+    slos = [slo for (slo, _, _) in loaded]
+    predictions = analyse.segment_batch(slos, locations, slosegmenter, avosegmenter, fovsegmenter, batch_size, fovea_map)
+
+    return dict(zip(fname_types, zip(loaded, predictions)))
 
 
 # Outer function to run analyse script through directory of .vol files
@@ -44,6 +102,15 @@ def run(args):
         print("Exiting analysis. Please correctly specify the dirctory of files and run SLOctolyzer again.")
         sys.exit()
 
+    # Optional directory storing model probabilities per image, so re-runs skip segmentation
+    prob_store = args.get("probability_store_directory", None)
+
+    # Detect the fovea at reduced resolution, which is faster but slightly less precise
+    fast_fovea = args.get("fast_fovea", 0)
+
+    # Use the lite models distilled with sloctolyzer/segment/distill.py
+    tier = "lite" if args.get("lite_models", 0) else "full"
+
     # Detect img files from analysis_directory, so far supports image files types 
     # bmp/tif/png/jpeg, as well .vol support from Heidelberg proprietary extracts
     print(f"\nDetecting images to analyse...")
@@ -60,6 +127,13 @@ def run(args):
     else:
         print(f'Cannot find any supported files in {analysis_directory}. Please check directory. Exiting analysis')
         return
+
+    # Instantiate SLO binary/AVOD/Fovea segmentation models on background threads once there are
+    # files to analyse, while the resolution file is read and the first files loaded
+    model_loader = ThreadPoolExecutor(max_workers=3, thread_name_prefix="load_model")
+    segmenter_futures = [model_loader.submit(_load_segmenter, name, prob_store, tier, fast_fovea)
+                         for name in ["slo", "avo", "fov"]]
+    model_loader.shutdown(wait=False)
     
     # output directory
     save_directory = args["output_directory"]
@@ -72,6 +146,17 @@ def run(args):
     # any unexpected errors from a particular file. Setting it as 0 will throw up errors
     # for debugging
     robust_run = args["robust_run"]
+
+    # Number of images segmented together per forward pass. 1 segments each image
+    # individually within analyse()
+    batch_size = args.get("batch_size", 1)
+
+    # Number of CPU threads for segmentation, 0 leaves PyTorch's default of all cores and 
+    # auto times the models to choose
+    num_threads = args.get("num_threads", 0)
+
+    # Number of files read and decoded in the background ahead of the one being analysed
+    prefetch = args.get("prefetch", 0)
     save_ind_results = True
     save_ind_images = args["save_individual_segmentations"]
     collate_segs = True
@@ -81,12 +166,6 @@ def run(args):
     if collate_segs and not os.path.exists(segmentation_directory):
         os.mkdir(segmentation_directory)
 
-    # Instantiate SLO binary/AVOD/Fovea segmentation model
-    print(f"\nRunning En-face vessel SLO analysis.\n")
-    slosegmenter = slo_inference.SLOSegmenter()
-    avosegmenter = avo_inference.AVOSegmenter()
-    fovsegmenter = fov_inference.FOVSegmenter()
-
     # Detect and load resolution file
     res_fname = "fname_resolution_location_eye"
     res_path = os.path.join(analysis_directory, res_fname)
@@ -110,9 +189,36 @@ def run(args):
         elif format  == '.xlsx':
             res_df = pd.read_excel(resolution_path)
 
+    # Collect files which have not been analysed yet, to be segmented in batches
+    pending_paths = []
+    for path in img_paths:
+        fname = os.path.split(path)[1].split(".")[0]
+        if not os.path.exists(os.path.join(save_directory, fname, f"{fname}_output.xlsx")):
+            pending_paths.append(path)
+
+    # Read and decode the next unanalysed files on background threads while each file is analysed
+    prefetcher = None
+    if prefetch > 0:
+        prefetcher = Prefetcher(pending_paths, functools.partial(analyse.load_slo, verbose=False), depth=prefetch)
+
+    # Wait for the segmentation models, re-raising any error from loading them
+    print(f"\nRunning En-face vessel SLO analysis.\n")
+    slosegmenter, avosegmenter, fovsegmenter = [future.result() for future in segmenter_futures]
+    from sloctolyzer.segment import threads
+    if num_threads != "auto" and num_threads > 0:
+        threads.set_thread_budget(num_threads)
+    if num_threads == "auto":
+        print("Tuning number of threads for segmentation...")
+        tuned = threads.autotune([slosegmenter.model, avosegmenter.model, fovsegmenter.model], 
+                                 shape=(batch_size, 1, 768, 768))
+        # This run analyses files in turn, so uses the fastest setting for a single process
+        threads.set_thread_budget(tuned['run_threads'])
+        print(f"Using {tuned['run_threads']} threads. If processing a large dataset, splitting it across {tuned['num_workers']} copies of SLOctolyzer run at the same time, each with num_threads: {tuned['num_threads']}, is fastest on this machine.\n")
+
     # Loop through .img files, segment, measure and save out in analyse()
     st = time.time()
     result_dict = {}
+    batch_dict = {}
     for path in tqdm(img_paths):
 
         if isinstance(path, PosixPath):
@@ -239,21 +345,31 @@ def run(args):
             location = None
             eye = None
             if ftype != 'vol':
-                fname_res_loc = res_df[res_df.Filename == fname_type]
-                if fname_res_loc.shape[0] == 0:
-                    print(f"\n\nCan't find information on {fname}. If fname_resolution_location.xlsx specified, check filename spelling?")
-                    print(f"Falling back to default state of not using a scale and automatically detecting centering.")
-                else:
-                    # extract scale and location. If unspecified, set to None
-                    scale = fname_res_loc.iloc[0].Scale
-                    if pd.isna(scale):
-                        scale = None
-                    location = fname_res_loc.iloc[0].Location
-                    if pd.isna(location):
-                        location = None
-                    eye = fname_res_loc.iloc[0].Eye
-                    if pd.isna(eye):
-                        eye = None
+                scale, location, eye = _get_resolution(res_df, fname_type)
+
+            # Segment this file together with the next batch_size-1 unanalysed files. If this fails,
+            # files fall back to being loaded and segmented individually within analyse()
+            if batch_size > 1 and fname_type not in batch_dict:
+                idx = pending_paths.index(path)
+                batch_paths = pending_paths[idx:idx+batch_size]
+                try:
+                    batch_dict = _segment_batch(batch_paths, res_df, slosegmenter, 
+                                                avosegmenter, fovsegmenter, batch_size, save_ind_images, prefetcher)
+                except Exception as e:
+                    if not robust_run:
+                        raise e
+                    print(f"\n\nFailed to segment batch of {len(batch_paths)} files together ({type(e).__name__}: {e}).")
+                    print("Falling back to segmenting these files individually.")
+                    batch_dict = {os.path.split(p)[1]:(None, None) for p in batch_paths}
+            preloaded, predictions = batch_dict.pop(fname_type, (None, None))
+
+            # Collect this file from the background loader. If loading failed, analyse() loads it
+            # again itself, so the error is handled like any other
+            if preloaded is None and prefetcher is not None:
+                try:
+                    preloaded = prefetcher.get(path)
+                except Exception:
+                    preloaded = None
 
             # For robust run, i.e. unexpected errors do not hault run and instead moved onto next image.
             if robust_run:
@@ -269,7 +385,9 @@ def run(args):
                                     save_ind_results,
                                     save_ind_images,
                                     collate_segs,
-                                    compute_metrics=True)
+                                    compute_metrics=True,
+                                    preloaded=preloaded,
+                                    predictions=predictions)
                     ind_df, slo_dfs, _, _, logging_list = output
                     result_dict[fname_type] = ind_df, slo_dfs, logging_list
                     
@@ -289,10 +407,15 @@ def run(args):
                                 save_ind_results,
                                 save_ind_images,
                                 collate_segs,
-                                compute_metrics=True)
+                                compute_metrics=True,
+                                preloaded=preloaded,
+                                predictions=predictions)
                 ind_df, slo_dfs, _, _, logging_list = output
                 result_dict[fname_type] = ind_df, slo_dfs, logging_list
 
+    if prefetcher is not None:
+        prefetcher.close()
+
     # collate all results into a single dataframe
     print(f"\n\nCollecting all results together into one output file.")
     all_logging_list = []
@@ -408,6 +531,30 @@ if __name__ == "__main__":
             msg = f"No value entered for {key}. Please check config.txt. Exiting analysis"
             sys.exit(msg)
 
+        # Batch size can be any positive integer
+        if key == "batch_size":
+            try:
+                assert param.isdigit() and int(param) > 0, f"{key} must be a positive integer, not {param}. Exiting analysis."
+            except AssertionError as msg:
+                sys.exit(msg)
+            continue
+
+        # Number of files to prefetch can be any non-negative integer
+        if key == "prefetch":
+            try:
+                assert param.isdigit(), f"{key} must be a non-negative integer, not {param}. Exiting analysis."
+            except AssertionError as msg:
+                sys.exit(msg)
+            continue
+
+        # Number of threads can be any non-negative integer, or auto
+        if key == "num_threads":
+            try:
+                assert param.isdigit() or param == "auto", f"{key} must be a non-negative integer or auto, not {param}. Exiting analysis."
+            except AssertionError as msg:
+                sys.exit(msg)
+            continue
+
         # All remaining inputs should be either 0 or 1 
         try:
             assert param in ["0", "1"], f"{key} flag must be either 0 or 1, not {param}. Exiting analysis."
@@ -415,7 +562,7 @@ if __name__ == "__main__":
             sys.exit(msg)
 
     # Construct args dict and run
-    args = {key:val if ("directory" in key) else int(val) for (key,val) in params.items()}
+    args = {key:val if ("directory" in key) else (val.strip() if "auto" in val else int(val)) for (key,val) in params.items()}
 
     # run analysis
     run(args)
\ No newline at end of file
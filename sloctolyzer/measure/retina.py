@@ -20,11 +20,9 @@ import base64
 import math
 import numpy as np
 import warnings
-import torch
 from copy import copy
 from io import BytesIO
 from sloctolyzer.measure.function_ import thinning
-from matplotlib import pyplot as plt
 from os import path
 from PIL import Image
 from scipy import ndimage
@@ -251,6 +249,7 @@ class Retina(object):
 
     def view(self):  # pragma: no cover
         """show a window with the internal image"""
+        from matplotlib import pyplot as plt
         io.imshow(self.np_image)
         plt.show()
 
@@ -374,6 +373,7 @@ class Window(Retina):
         return image
 
     def view_window(self, w_id, layer):  # pragma: no cover
+        from matplotlib import pyplot as plt
         io.imshow(self.windows[w_id, layer])
         plt.show()
 
@@ -400,6 +400,8 @@ class Window(Retina):
 
         REPLACED create_windows() BELOW ON 26/02/24
         '''
+        import torch
+
         # Patching stride and patch
         x = torch.tensor(x.np_image)
         H, W = x.shape
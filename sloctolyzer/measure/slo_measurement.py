@@ -1,5 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.ndimage import convolve
 from skimage.morphology import skeletonize
 from skimage import measure, graph
@@ -457,6 +456,7 @@ def vessel_metrics(window: Window,
     
     # Plotting the individual vessels on the vessel image
     if plot:
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots(1,1,figsize=(6,6))
         ax.imshow(window.vessel_image)
         for vessel in vessels:
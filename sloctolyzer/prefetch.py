@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    """
+    Loads files on a pool of threads ahead of their use, so that reading and decoding the
+    next files, e.g. from network storage, overlaps with segmenting and measuring the current
+    one. At most depth files are being loaded or held in memory ahead of the last file
+    collected with get(), so loading never runs away from analysis.
+
+    Files should be collected in the order of paths. A file that was not prefetched is
+    loaded directly when collected, and files skipped over are discarded.
+
+    Inputs:
+    -------------------
+    paths (list) : Paths of the files to load, in the order they will be collected.
+
+    load_fn (callable) : Function loading a single path, e.g. analyse.load_slo.
+
+    depth (int) : Number of files loaded ahead.
+
+    num_workers (int) : Number of loading threads, defaults to depth.
+    """
+    def __init__(self, paths, load_fn, depth=4, num_workers=None):
+        if depth < 1:
+            raise ValueError(f"depth must be a positive integer, not {depth}.")
+        self.paths = list(paths)
+        self.load_fn = load_fn
+        self.depth = depth
+        self._index = {path:i for (i, path) in enumerate(self.paths)}
+        self._futures = {}
+        self._next = 0
+        self._done = 0
+        self._executor = ThreadPoolExecutor(max_workers=depth if num_workers is None else num_workers,
+                                            thread_name_prefix='prefetch')
+        self._fill()
+
+    def _fill(self):
+        """Start loading files until depth files ahead of the last collected are in flight"""
+        while self._next < min(self._done + self.depth, len(self.paths)):
+            path = self.paths[self._next]
+            self._futures[path] = self._executor.submit(self.load_fn, path)
+            self._next += 1
+
+    def get(self, path):
+        """Loaded file at path, raising any error from loading it"""
+        future = self._futures.pop(path, None)
+        if path in self._index and self._index[path] >= self._done:
+            # Discard files skipped over, then load further ahead
+            for skipped in self.paths[self._done:self._index[path]]:
+                skipped = self._futures.pop(skipped, None)
+                if skipped is not None:
+                    skipped.cancel()
+            self._done = self._index[path] + 1
+            self._next = max(self._next, self._done)
+            self._fill()
+        if future is None:
+            return self.load_fn(path)
+        return future.result()
+
+    def close(self):
+        """Stop loading, discarding any files not yet collected"""
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(depth={self.depth}, collected={self._done}/{len(self.paths)})'
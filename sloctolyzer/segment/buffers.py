@@ -0,0 +1,80 @@
+import torch
+
+
+class BufferPool:
+    """
+    Preallocated tensors reused by a segmenter across calls to predict_img, one per name, shape,
+    dtype and device, so that segmenting many images does not allocate and free a new set of
+    (768,768) to (1536,1536) float buffers per image. Host buffers feeding or collecting from a
+    GPU are pinned, so copies to and from it are asynchronous.
+
+    Buffers are overwritten by the next image, so anything returned to the caller must be a copy,
+    and a segmenter with a pool should only be used by one thread at a time.
+
+    Inputs:
+    -------------------
+    device (str) : Device the model runs on.
+
+    max_buffers (int) : Number of buffers kept, the least recently used being freed first, so
+                        cohorts with many different image resolutions do not hold a set for each.
+    """
+    def __init__(self, device='cpu', max_buffers=16):
+        self.device = torch.device(device)
+        self.pin_memory = self.device.type == 'cuda'
+        self.max_buffers = max_buffers
+        self._buffers = {}
+
+    def get(self, name, shape, dtype=torch.float32, device='cpu'):
+        """Buffer for name of the given shape, dtype and device, zero-filled when first allocated"""
+        device = torch.device(device)
+        key = (name, tuple(shape), dtype, device)
+        buffer = self._buffers.pop(key, None)
+        if buffer is None:
+            pin = self.pin_memory and device.type == 'cpu'
+            buffer = torch.zeros(shape, dtype=dtype, device=device, pin_memory=pin)
+            if len(self._buffers) >= self.max_buffers:
+                del self._buffers[next(iter(self._buffers))]
+        # Most recently used last
+        self._buffers[key] = buffer
+        return buffer
+
+    def input(self, img, factor=None, mean=None, std=None):
+        """
+        uint8 (C,M,N) image as a (1,C,M',N') float model input on the pool's device, scaled to
+        [0,1], normalised if mean and std are given, and padded with zeros to a multiple of factor,
+        exactly as the segmenters' default transforms. Returns the input and unpadded (M,N).
+        """
+        C, M, N = img.shape
+        Mp, Np = (M, N) if factor is None else (M + (-M) % factor, N + (-N) % factor)
+        x = self.get('input', (1, C, Mp, Np))
+        # Padding is zero from allocation and never written, so only the image region is filled
+        view = x[0, :, :M, :N]
+        view.copy_(img).mul_(1.0 / 255)
+        if mean is not None:
+            view.sub_(mean).div_(std)
+        if self.device.type != 'cpu':
+            x = self.get('input', x.shape, device=self.device).copy_(x, non_blocking=True)
+        return x, (M, N)
+
+    def resize(self, pred, img_shape):
+        """
+        (M,N) or (C,M,N) float map resized to img_shape, bilinearly with antialiasing as T.Resize,
+        into a buffer. pred is returned as is if already at img_shape.
+        """
+        if tuple(img_shape) == tuple(pred.shape[-2:]):
+            return pred
+        out = self.get('resized', (*pred.shape[:-2], *img_shape), pred.dtype, pred.device)
+        torch.ops.aten._upsample_bilinear2d_aa.out(pred.reshape(1, -1, *pred.shape[-2:]), list(img_shape), False,
+                                                   None, None, out=out.view(1, -1, *img_shape))
+        return out
+
+    def threshold(self, pred, threshold):
+        """Boolean mask of pred > threshold as a numpy array, via a pinned host buffer if on GPU"""
+        mask = torch.gt(pred, threshold, out=self.get('mask', pred.shape, torch.bool, pred.device))
+        if mask.device.type != 'cpu':
+            mask = self.get('mask', pred.shape, torch.bool).copy_(mask)
+        return mask.numpy()
+
+    def __repr__(self):
+        n_bytes = sum(buf.numel() * buf.element_size() for buf in self._buffers.values())
+        return f'{self.__class__.__name__}(device={self.device}, buffers={len(self._buffers)}, {n_bytes / 2**20:.1f} MB)'
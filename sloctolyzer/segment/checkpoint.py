@@ -0,0 +1,81 @@
+import os
+import pickle
+import argparse
+import torch
+from sloctolyzer.segment.unet.unet_model import UNet
+from sloctolyzer.segment import optimise
+
+
+def get_config(model):
+    """Architecture config of a UNet, enough to rebuild it with UNet(**config)"""
+    for attr in ['n_channels', 'n_classes', 'bilinear', 'inc']:
+        if not hasattr(model, attr):
+            raise ValueError(f"{model.__class__.__name__} is not a UNet, it has no attribute {attr}.")
+    first_conv = model.inc.double_conv[0]
+    return {'n_channels': model.n_channels,
+            'n_classes': model.n_classes,
+            'bilinear': model.bilinear,
+            'kernel_size': first_conv.kernel_size[0],
+            'mc': 16*first_conv.out_channels}
+
+
+def save_checkpoint(model, path, fuse_bn=True):
+    """
+    Save a UNet as its architecture config and state dict. If fuse_bn, BatchNorms are folded
+    into the convolutions first, so the saved weights are used as-is when loaded.
+    """
+    config = get_config(model)
+    model = model.eval()
+    if fuse_bn:
+        model = optimise.fuse_model(model)
+    config['fused'] = fuse_bn
+    save_dir = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    state_dict = {k: v.detach().cpu().contiguous() for (k, v) in model.state_dict().items()}
+    torch.save({'config': config, 'state_dict': state_dict}, path)
+    return path
+
+
+def load_checkpoint(path, map_location='cpu'):
+    """
+    Build a UNet from a checkpoint saved by save_checkpoint. The file is memory-mapped and
+    its tensors used directly as the model's parameters on CPU, so processes loading the
+    same file share its pages rather than each holding a private copy.
+    """
+    checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    config = dict(checkpoint['config'])
+    fused = config.pop('fused', False)
+    with torch.device('meta'):
+        model = UNet(**config).eval()
+        if fused:
+            model = optimise.fuse_model(model)
+    model.load_state_dict(checkpoint['state_dict'], assign=True)
+    return model.to(map_location).eval()
+
+
+def load_model(path, map_location='cpu'):
+    """
+    Load a segmentation model from a checkpoint, falling back to unpickling a full nn.Module
+    for weights saved in the original release format.
+    """
+    try:
+        return load_checkpoint(path, map_location)
+    except (pickle.UnpicklingError, KeyError, TypeError):
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+
+def convert(src_path, dst_path, fuse_bn=True):
+    """Convert weights saved as a pickled UNet module to a checkpoint"""
+    model = torch.load(src_path, map_location='cpu', weights_only=False)
+    return save_checkpoint(model, dst_path, fuse_bn)
+
+
+# Once called from terminal
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert SLOctolyzer weights saved as pickled modules to state dict checkpoints.")
+    parser.add_argument("src_path", help="Weights saved as a pickled UNet module.")
+    parser.add_argument("dst_path", help="Path to save the checkpoint to.")
+    parser.add_argument("--no_fuse", action="store_true", help="Keep BatchNorm layers separate in the checkpoint.")
+    args = parser.parse_args()
+    convert(args.src_path, args.dst_path, fuse_bn=not args.no_fuse)
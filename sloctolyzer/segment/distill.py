@@ -0,0 +1,147 @@
+import os
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+from tqdm.autonotebook import tqdm
+from sloctolyzer.segment.preprocess import prepare_img
+from sloctolyzer.segment.unet.unet_model import UNet
+from sloctolyzer.segment import validate, checkpoint, registry
+
+SCRIPT_PATH = os.path.realpath(os.path.dirname(__file__))
+STUDENT_MC = 128
+STUDENT_KERNEL_SIZE = 3
+
+
+def _teacher_targets(teacher, img_list):
+    """Model inputs for img_list, transformed exactly as in predict_img, and the teacher's probabilities of every class"""
+    inputs = []
+    targets = []
+    with torch.inference_mode():
+        for img in tqdm(img_list, desc='Teacher', leave=False):
+            x = teacher.transform(prepare_img(img).resized())
+            x = x[0] if isinstance(x, tuple) else x
+            x = x.unsqueeze(0).to(teacher.device)
+            inputs.append(x.cpu())
+            targets.append(teacher.model(x).float().sigmoid().cpu().half())
+    return torch.cat(inputs), torch.cat(targets)
+
+
+def _forward_time(model, x, n_runs=3):
+    """Mean time of a forward pass of model on x, after one warm-up pass"""
+    with torch.inference_mode():
+        model(x)
+        st = time.perf_counter()
+        for _ in range(n_runs):
+            model(x)
+    return (time.perf_counter() - st) / n_runs
+
+
+def train_student(student, inputs, targets, epochs=30, batch_size=4, lr=1e-3, device='cpu'):
+    """
+    Fit the student's logits to the teacher's soft targets with binary cross-entropy, flipping
+    inputs and targets at random. Targets are soft probabilities rather than thresholded masks,
+    so the student also learns where the teacher is uncertain.
+    """
+    student = student.to(device).train()
+    optimizer = torch.optim.Adam(student.parameters(), lr=lr)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=epochs)
+    pbar = tqdm(range(epochs), desc='Distilling', leave=False)
+    for _ in pbar:
+        total = 0
+        for idx in torch.randperm(len(inputs)).split(batch_size):
+            x = inputs[idx].to(device)
+            y = targets[idx].float().to(device)
+            if torch.rand(1).item() < 0.5:
+                x, y = x.flip(-1), y.flip(-1)
+            loss = F.binary_cross_entropy_with_logits(student(x), y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * len(idx)
+        scheduler.step()
+        pbar.set_postfix(loss=total/len(inputs))
+
+    return student.eval()
+
+
+def distill_segmenter(teacher, train_list, save_path, val_list=None, mc=STUDENT_MC, kernel_size=STUDENT_KERNEL_SIZE,
+                      epochs=30, batch_size=4, lr=1e-3, min_dice=0.9):
+    """
+    Distill a SLOSegmenter, AVOSegmenter or FOVSegmenter into a smaller UNet with mc channels
+    at its bottleneck and kernel_size convolutions, trained on the teacher's soft predictions
+    for the images in train_list. The student is saved as a checkpoint to save_path and its
+    Dice agreement with the teacher reported on val_list, or train_list if not given.
+
+    Returns whether every class' mean Dice is at least min_dice, and the per-image Dice scores.
+    """
+    name = teacher.__class__.__name__
+    inputs, targets = _teacher_targets(teacher, train_list)
+    student = UNet(n_channels=inputs.shape[1], n_classes=targets.shape[1], kernel_size=kernel_size, mc=mc)
+    student = train_student(student, inputs, targets, epochs, batch_size, lr, teacher.device)
+    # Saved unfused, so installing it also installs the unfused copy loaded with fuse_bn=False
+    checkpoint.save_checkpoint(student, save_path, fuse_bn=False)
+
+    student_segmenter = teacher.__class__(threshold=teacher.threshold, local_model_path=save_path)
+    x = inputs[:1].to(teacher.device)
+    speedup = _forward_time(teacher.model, x) / _forward_time(student_segmenter.model, x)
+    n_params = [sum(p.numel() for p in model.parameters()) for model in [teacher.model, student_segmenter.model]]
+    print(f"{name} student: {n_params[1]:,} parameters (teacher {n_params[0]:,}), {speedup:.1f}x faster per (768,768) pass.")
+
+    dices = validate.compare_predictions(teacher, student_segmenter, train_list if val_list is None else val_list)
+    accepted = validate.print_dice_report(name, dices, min_dice)
+    if not accepted:
+        print(f"    Student model saved to {save_path} but should not be used.")
+
+    return accepted, dices
+
+
+def distill_segmenters(img_list, save_directory, val_fraction=0.2, min_dice=0.9, cache_dir=None, **kwargs):
+    """
+    Distill SLOSegmenter, AVOSegmenter and FOVSegmenter into lite students, saving each to
+    save_directory. The last val_fraction of img_list is held out to validate against each
+    teacher, and students agreeing to within min_dice are installed into the weight cache as
+    the 'lite' tier, to be loaded with tier='lite' on each segmenter.
+    """
+    from sloctolyzer.segment import slo_inference, avo_inference, fov_inference
+    n_val = int(round(val_fraction*len(img_list)))
+    train_list, val_list = (img_list[:-n_val], img_list[-n_val:]) if 0 < n_val < len(img_list) else (img_list, None)
+
+    results = {}
+    for name, segmenter in [("slosegmenter", slo_inference.SLOSegmenter),
+                            ("avosegmenter", avo_inference.AVOSegmenter),
+                            ("fovsegmenter", fov_inference.FOVSegmenter)]:
+        lite_url = registry.tier_url(registry.MODELS[name], 'lite')
+        save_path = os.path.join(save_directory, os.path.basename(lite_url))
+        accepted = distill_segmenter(segmenter(), train_list, save_path, val_list, min_dice=min_dice, **kwargs)[0]
+        if accepted:
+            path = registry.install(lite_url, cache_dir, source_directory=save_directory)
+            print(f"    Installed {name} lite tier to {path}")
+        results[name] = accepted
+
+    return results
+
+
+# Once called from terminal
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distill SLOctolyzer's segmentation models into smaller, faster 'lite' models.")
+    parser.add_argument("image_directory", help="Directory of SLO images to distill and validate with.")
+    parser.add_argument("save_directory", nargs="?", default=os.path.join(SCRIPT_PATH, "weights"),
+                        help="Directory to save the student models to.")
+    parser.add_argument("--mc", type=int, default=STUDENT_MC, help="Channels at the student's bottleneck, 512 for the full UNet.")
+    parser.add_argument("--kernel_size", type=int, default=STUDENT_KERNEL_SIZE, help="Convolution kernel size of the student.")
+    parser.add_argument("--epochs", type=int, default=30, help="Number of passes over the training images.")
+    parser.add_argument("--batch_size", type=int, default=4, help="Number of images per training step.")
+    parser.add_argument("--lr", type=float, default=1e-3, help="Initial learning rate, decayed with a cosine schedule.")
+    parser.add_argument("--val_fraction", type=float, default=0.2, help="Fraction of images held out to validate against the teacher.")
+    parser.add_argument("--min_dice", type=float, default=0.9,
+                        help="Minimum mean Dice against the teacher to install a student as the lite tier.")
+    parser.add_argument("--cache_dir", default=None, help="Weight cache directory to install lite models into.")
+    args = parser.parse_args()
+
+    img_types = (".bmp", ".png", ".tif", ".jpg", ".jpeg")
+    img_list = sorted(os.path.join(args.image_directory, f) for f in os.listdir(args.image_directory)
+                      if f.lower().endswith(img_types))
+    distill_segmenters(img_list, args.save_directory, args.val_fraction, args.min_dice, args.cache_dir,
+                       mc=args.mc, kernel_size=args.kernel_size, epochs=args.epochs,
+                       batch_size=args.batch_size, lr=args.lr)
@@ -11,8 +11,10 @@ from torchvision.transforms import v2 as T
 from torchvision.transforms import functional as TF
 from torchvision import tv_tensors
 import torch.nn as nn
+from sloctolyzer.segment import segmenter
 
 SCRIPT_PATH = os.path.realpath(os.path.dirname(__file__))
+FAST_SIZE = (384, 384)
 
 class FixShape(T.Transform):
     def __init__(self, factor=32):
@@ -31,43 +33,23 @@ class FixShape(T.Transform):
     
 
 def get_default_img_transforms():
-    """Tensor, dimension and normalisation default augs"""
+    """Dtype and dimension default augs, applied to the shared uint8 (768,768) input"""
     return T.Compose([
-        T.PILToTensor(),
-        T.Resize(size=(768,768), antialias=True),
         T.ToDtype(torch.float32, scale=True),
         FixShape(factor=32)
     ])
  
 
 
-class ImgListDataset(Dataset):
-    """Torch Dataset from img list"""
-    def __init__(self, img_list):
-        self.img_list = img_list
-        if isinstance(img_list[0], (str, PurePath, PosixPath)):
-            self.is_arr = False
-        elif isinstance(img_list[0], np.ndarray):
-            self.is_arr = True
-        self.transform = get_default_img_transforms()
-
-    def __len__(self):
-        return len(self.img_list)
+class ImgListDataset(segmenter.ImgListDataset):
+    """Torch Dataset from img list, of any mix of resolutions"""
+    def __init__(self, img_list, size=None):
+        super().__init__(img_list, get_default_img_transforms(), size)
 
-    def __getitem__(self, idx):
-        if self.is_arr:
-            img_uint = (255*(self.img_list[idx]/self.img_list[idx].max())).astype(np.uint8)
-            img = ImageOps.grayscale(Image.fromarray(img_uint))
-        else:
-            img = ImageOps.grayscale(Image.open(self.img_list[idx]))
-            
-        img, shape = self.transform(img)
-        return {'img': img, "crop":shape} 
 
-
-def get_img_list_dataloader(img_list, batch_size=16, num_workers=0, pin_memory=False):
+def get_img_list_dataloader(img_list, batch_size=16, num_workers=0, pin_memory=False, size=None):
     """Wrapper of Dataset into DataLoader"""
-    dataset = ImgListDataset(img_list)
+    dataset = ImgListDataset(img_list, size)
     loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
                         pin_memory=pin_memory)
     return loader
@@ -123,107 +105,91 @@ def _get_fovea(pred, threshold=0.5):
     fovea = np.array(region.centroid).astype(int)[[1,0]]
     
     return fovea
+
+
+def _rescale_fovea(fovea, pred_shape, img_shape):
+    """Map a fovea (x,y) coordinate from a (M,N) prediction to an image of native img_shape"""
+    scale = np.array([img_shape[1] / pred_shape[1], img_shape[0] / pred_shape[0]])
+    return np.round((np.asarray(fovea) + 0.5) * scale - 0.5).astype(int)
     
 
-class FOVSegmenter:
+class FOVSegmenter(segmenter.Segmenter):
 
     DEFAULT_MODEL_URL = 'https://github.com/jaburke166/SLOctolyzer/releases/download/v1.0/fovsegmenter_weights.pth'
     DEFAULT_THRESHOLD = 0.5
     DEFAULT_MODEL_PATH = None
     # DEFAULT_MODEL_PATH = os.path.join(SCRIPT_PATH, r"weights/fovsegmenter_weights.pth")  
+    NAME = 'Fovea detection'
     
-    def __init__(self, model_path=DEFAULT_MODEL_URL, threshold=DEFAULT_THRESHOLD, local_model_path=DEFAULT_MODEL_PATH):
+    def __init__(self, model_path=DEFAULT_MODEL_URL, threshold=DEFAULT_THRESHOLD, local_model_path=DEFAULT_MODEL_PATH,
+                 fast_size=None, **kwargs):
         """
-        Core inference class for Fovea SLO segmentation model
+        Core inference class for Fovea SLO segmentation model.
+
+        fast_size, e.g. FAST_SIZE=(384,384), runs the model at this reduced input size and detects
+        the fovea at that scale, only resizing the fovea map to native resolution if it is requested
+        with return_map. tile_size is not supported, as locating the fovea needs the whole image.
+        See Segmenter for the other options.
         """
+        if kwargs.get('tile_size') is not None:
+            raise ValueError("FOVSegmenter does not support tile_size, as locating the fovea needs the whole image.")
+        super().__init__(model_path, threshold, local_model_path, **kwargs)
         self.transform = get_default_img_transforms()
-        self.threshold = threshold
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        #self.device = "mps" if torch.backends.mps.is_available() else "cpu"
-        if local_model_path is not None:
-            self.model = torch.load(local_model_path, map_location=self.device)
-        else:
-            self.model = torch.hub.load_state_dict_from_url(model_path, map_location=self.device)
-        if self.device != "cpu":
-            print("Fovea detection has been loaded with GPU acceleration!")
-        self.model.eval()
+        self.fast_size = None if fast_size is None else tuple(fast_size)
+        self.input_size = self.fast_size
         
-    @torch.inference_mode()
-    def predict_img(self, img, soft_pred=False):
+    def _postprocess(self, pred, img_shape, soft_pred=False, return_map=True):
         """
-        Inference on a single image
+        Resize a cropped (1,M,N) fovea probability map back to native resolution
+        and extract the fovea, shared by single image and batched inference.
+        The map is None if not return_map.
         """
-        if isinstance(img, (str, PurePath, PosixPath)):
-            img = ImageOps.grayscale(Image.open(img))
-            img_shape = (img.height, img.width)
-        elif isinstance(img, np.ndarray):
-            img_shape = img.shape
-            img = exposure.rescale_intensity(img, in_range='image', out_range=(0,255))
-            img = ImageOps.grayscale(Image.fromarray(img))
-
-        # If downsamples to (768,768), prepare for upsampling
-        if img_shape != (768,768):
-            RESIZE = T.Resize(img_shape, antialias=True)
-        else:
-            RESIZE = None
-            
-        with torch.no_grad():
-            img, (M, N) = self.transform(img)
-            img = img.unsqueeze(0).to(self.device)
-            pred = self.model(img).squeeze(0).sigmoid()[:M, :N]
-
-            # Resize back to native resolution
-            if RESIZE is not None:
-                pred = RESIZE(tv_tensors.Image(pred))
-
-            # Return if soft_pred, otherwise post-process
-            if soft_pred:
-                return pred.cpu().numpy()[0]
-            fovea = _get_fovea(pred, self.threshold)
-    
+        # In fast mode the fovea is found at model scale, only resizing the map if it is needed
+        if self.fast_size is not None and not soft_pred:
+            fovea = _rescale_fovea(_get_fovea(pred, self.threshold), pred.shape[-2:], img_shape)
+            if not return_map:
+                return None, fovea
+            if self.buffers is not None:
+                return self.buffers.resize(pred, img_shape)[0].cpu().numpy().copy(), fovea
+            if img_shape != tuple(pred.shape[-2:]):
+                pred = T.Resize(img_shape, antialias=True)(tv_tensors.Image(pred))
             return pred[0].cpu().numpy(), fovea
 
-    def predict_list(self, img_list, soft_pred=False):
+        # Resize back to native resolution, into a reused buffer if pooling
+        if self.buffers is not None and not soft_pred:
+            pred = self.buffers.resize(pred, img_shape)
+        elif img_shape != tuple(pred.shape[-2:]):
+            pred = T.Resize(img_shape, antialias=True)(tv_tensors.Image(pred))
+
+        # Return if soft_pred, otherwise post-process
+        if soft_pred:
+            return pred.cpu().numpy()[0]
+        fovea = _get_fovea(pred, self.threshold)
+        if not return_map:
+            return None, fovea
+
+        # A pooled map is overwritten by the next image, so is copied
+        fovmap = pred[0].cpu().numpy()
+        return (fovmap.copy() if self.buffers is not None else fovmap), fovea
+        
+    def predict_img(self, img, soft_pred=False, return_map=True):
+        """
+        Inference on a single image. img can be a path, numpy array, torch tensor
+        or a PreparedImg shared with the other segmenters. If not return_map, only
+        the fovea is needed and None is returned in place of the fovea map.
+        """
+        return self._predict_one(img, soft_pred, return_map)
+
+    def predict_list(self, img_list, soft_pred=False, return_map=True):
         """Inference on a list of images without batching"""
-        preds = []
-        foveas = []
-        with torch.no_grad():
-            for img in tqdm(img_list, desc='Predicting', leave=False):
-                pred, fovea = self.predict_img(img, soft_pred=soft_pred)
-                preds.append(pred)
-                foveas.append(fovea)
-        return preds, foveas
-
-    # Mixed resolution will not work here.
-    # Currently does not support resizing to common (768,768) resolution
-    def _predict_loader(self, loader, soft_pred=False):
-        """Inference from a DataLoader"""
-        preds = []
-        foveas = []
-        with torch.no_grad():
-            for batch in tqdm(loader, desc='Predicting', leave=False):
-                img = batch['img'].to(self.device)
-                batch_M, batch_N = batch['crop']
-                pred = self.model(img).sigmoid()
-                if not soft_pred:
-                    fovea = [_get_fovea(p, self.threshold) for p in pred]
-                pred = [p[:M,:N] for (p, M, N) in zip(pred, batch_M, batch_N)]
-                preds.append(pred)
-                foveas.append(fovea)
-        return preds, foveas
-
-    def predict_batch(self, img_list, soft_pred=False, batch_size=16, num_workers=0, pin_memory=False):
-        """Wrapper for DataLoader inference"""
-        loader = get_img_list_dataloader(img_list, 
-                                         batch_size=batch_size, 
-                                         num_workers=num_workers,
-                                         pin_memory=pin_memory)
-        preds, foveas = self._predict_loader(loader, soft_pred=soft_pred)
-        return preds, foveas
-
-    def __call__(self, x):
-        """Direct call for inference on single image"""
-        return self.predict_img(x)
+        outputs = self._predict_list(img_list, len(img_list)*[(soft_pred, return_map)])
+        return self._unzip(outputs, soft_pred)
 
-    def __repr__(self):
-        return f'{self.__class__.__name__}(threshold={self.threshold})'
\ No newline at end of file
+    def predict_batch(self, img_list, soft_pred=False, batch_size=16, num_workers=0, pin_memory=False, return_map=True):
+        """
+        Wrapper for DataLoader inference, returning one prediction and fovea per image
+        in img_list, identical to predict_img. Foveas are None if soft_pred, predictions
+        are None if not return_map.
+        """
+        outputs = self._predict_batch(img_list, len(img_list)*[(soft_pred, return_map)], batch_size, num_workers, pin_memory)
+        return self._unzip(outputs, soft_pred)
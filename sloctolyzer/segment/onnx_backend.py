@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import argparse
+import torch
+
+SCRIPT_PATH = os.path.realpath(os.path.dirname(__file__))
+ONNX_OPSET = 17
+
+
+def export_onnx(model, onnx_path, n_channels=1, img_size=(768,768), opset=ONNX_OPSET):
+    """
+    Export a segmentation UNet to an ONNX graph, with dynamic batch and spatial dimensions
+    so batched and (768,768) single image inference share the same graph.
+    """
+    model = model.eval()
+    dummy = torch.zeros(1, n_channels, *img_size, device=next(model.parameters()).device)
+    dynamic_axes = {'img':{0:'batch', 2:'height', 3:'width'},
+                    'logits':{0:'batch', 2:'height', 3:'width'}}
+    onnx_dir = os.path.dirname(os.path.abspath(onnx_path))
+    if not os.path.exists(onnx_dir):
+        os.makedirs(onnx_dir)
+    with torch.no_grad():
+        torch.onnx.export(model, dummy, onnx_path,
+                          input_names=['img'],
+                          output_names=['logits'],
+                          dynamic_axes=dynamic_axes,
+                          opset_version=opset,
+                          dynamo=False)
+    return onnx_path
+
+
+class ONNXModel:
+    """
+    Drop-in replacement for a segmenter's PyTorch model, running an exported graph with
+    onnxruntime's CPU execution provider. Takes and returns torch tensors so that all
+    existing post-processing is left unchanged.
+    """
+    def __init__(self, onnx_path, num_threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The ONNX backend requires onnxruntime. Install it with 'pip install onnxruntime'.")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.onnx_path = onnx_path
+        self.session = ort.InferenceSession(onnx_path, sess_options=options,
+                                            providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def __call__(self, img):
+        logits = self.session.run(None, {self.input_name: img.detach().cpu().numpy()})[0]
+        return torch.from_numpy(logits).to(img.device)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.onnx_path})'
+
+
+def cached_onnx_path(model, weights_path, cache_dir=None, opset=ONNX_OPSET):
+    """
+    Path of model's ONNX graph in the weight cache, keyed by the SHA-256 of the weights it was
+    loaded from, whether its BatchNorms were fused and the opset, so a graph is only reused
+    for the same weights and settings.
+    """
+    from sloctolyzer.segment import registry
+    fused = not any(isinstance(module, torch.nn.modules.batchnorm._BatchNorm) for module in model.modules())
+    stem = os.path.splitext(os.path.basename(weights_path))[0]
+    key = f"{registry.checksum(weights_path, cache_dir)[:16]}{'_fused' if fused else ''}_opset{opset}"
+    return os.path.join(registry.get_cache_dir(cache_dir), 'onnx', f"{stem}_{key}.onnx")
+
+
+def load_onnx_model(model, onnx_path=None, num_threads=None, weights_path=None, cache_dir=None):
+    """
+    Wrap an already-loaded PyTorch model as an ONNXModel. If onnx_path does not exist,
+    the model is exported there first. If onnx_path is None, the graph is exported once into
+    the weight cache under the checksum of weights_path, or if that is not given, to a
+    temporary file removed once loaded, so the graph always matches the loaded weights.
+    """
+    if onnx_path is None and weights_path is not None:
+        onnx_path = cached_onnx_path(model, weights_path, cache_dir)
+    if onnx_path is None:
+        tmp_dir = tempfile.mkdtemp(prefix="sloctolyzer_")
+        try:
+            return ONNXModel(export_onnx(model, os.path.join(tmp_dir, "model.onnx")), num_threads=num_threads)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    if not os.path.exists(onnx_path):
+        # Exported under a temporary name, so concurrent loads never read a partial graph
+        tmp_path = f"{onnx_path}.{os.getpid()}.tmp"
+        export_onnx(model, tmp_path)
+        os.replace(tmp_path, onnx_path)
+    return ONNXModel(onnx_path, num_threads=num_threads)
+
+
+def export_segmenters(save_directory, slo_model=None, avo_model=None, fov_model=None):
+    """
+    Export SLOSegmenter, AVOSegmenter and FOVSegmenter models to ONNX graphs in save_directory,
+    to be loaded with backend='onnx' and onnx_path=... on each segmenter.
+    """
+    from sloctolyzer.segment import slo_inference, avo_inference, fov_inference
+    if slo_model is None:
+        slo_model = slo_inference.SLOSegmenter()
+    if avo_model is None:
+        avo_model = avo_inference.AVOSegmenter()
+    if fov_model is None:
+        fov_model = fov_inference.FOVSegmenter()
+
+    onnx_paths = {}
+    for name, segmenter in zip(["slosegmenter", "avosegmenter", "fovsegmenter"], [slo_model, avo_model, fov_model]):
+        onnx_path = os.path.join(save_directory, f"{name}_weights.onnx")
+        onnx_paths[name] = export_onnx(segmenter.model, onnx_path)
+        print(f"Exported {name} to {onnx_path}")
+
+    return onnx_paths
+
+
+# Once called from terminal
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export SLOctolyzer's segmentation models to ONNX.")
+    parser.add_argument("save_directory", nargs="?", default=os.path.join(SCRIPT_PATH, "weights"),
+                        help="Directory to save the ONNX graphs to.")
+    args = parser.parse_args()
+    export_segmenters(args.save_directory)
@@ -0,0 +1,109 @@
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+COMPILE_MODES = ['script', 'compile']
+DEFAULT_WARMUP_SHAPES = [(1, 1, 768, 768)]
+
+
+def fuse_model(model):
+    """
+    Fold every BatchNorm2d that directly follows a Conv2d in an nn.Sequential, i.e. each
+    DoubleConv, into the convolution's weights and bias. The BatchNorm is replaced by an
+    Identity, so module indexing within each nn.Sequential is unchanged.
+    ReLUs are left in place for TorchScript, onnxruntime and oneDNN to fuse themselves.
+    """
+    model = model.eval()
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        for i in range(len(module)-1):
+            conv, bn = module[i], module[i+1]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                module[i] = fuse_conv_bn_eval(conv, bn)
+                module[i+1] = nn.Identity()
+    return model
+
+
+def bf16_supported(device='cpu'):
+    """Whether bfloat16 kernels are accelerated on device, e.g. AVX512-BF16 or AMX on CPU"""
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.is_bf16_supported()
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+class FastModel(nn.Module):
+    """
+    Runs a segmenter's model in channels-last memory format and/or under bfloat16 autocast,
+    returning float32 logits so that all post-processing is unchanged.
+    """
+    def __init__(self, model, channels_last=True, bf16=True):
+        super().__init__()
+        self.device = next(model.parameters()).device
+        if bf16 and not bf16_supported(self.device):
+            print(f"bfloat16 is not supported on this {self.device.type.upper()}, running in float32.")
+            bf16 = False
+        self.channels_last = channels_last
+        self.bf16 = bf16
+        self.model = model.eval()
+        if channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+
+    def forward(self, img):
+        if self.channels_last:
+            img = img.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            logits = self.model(img)
+        return logits.float().contiguous()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(channels_last={self.channels_last}, bf16={self.bf16})'
+
+
+class CompiledModel:
+    """
+    Wraps a segmenter's model in eval mode with a compiled inference graph per input shape.
+
+    mode='script' traces and freezes the model with TorchScript, caching one frozen graph per
+    input shape. mode='compile' uses torch.compile, which caches its own graph per shape.
+    Shapes in warmup_shapes are compiled at construction, so first-image latency is predictable.
+    """
+    def __init__(self, model, mode='script', warmup_shapes=DEFAULT_WARMUP_SHAPES):
+        if mode not in COMPILE_MODES:
+            raise ValueError(f"Unknown compile mode {mode}, must be one of {COMPILE_MODES}.")
+        self.model = model.eval()
+        self.mode = mode
+        self.device = next(model.parameters()).device
+        self.graphs = {}
+        if mode == 'compile':
+            self.compiled = torch.compile(self.model, dynamic=False)
+        for shape in warmup_shapes:
+            self.warmup(shape)
+
+    def _get_graph(self, shape):
+        """Trace and freeze the model for an input shape, once"""
+        if shape not in self.graphs:
+            with torch.inference_mode(False), torch.no_grad():
+                example = torch.zeros(shape, device=self.device)
+                graph = torch.jit.freeze(torch.jit.trace(self.model, example))
+            self.graphs[shape] = graph
+        return self.graphs[shape]
+
+    @torch.inference_mode()
+    def warmup(self, shape, n_runs=2):
+        """Compile for shape and run a few forward passes, so optimisation happens up front"""
+        example = torch.zeros(shape, device=self.device)
+        for _ in range(n_runs):
+            self(example)
+
+    def eval(self):
+        return self
+
+    def __call__(self, img):
+        if self.mode == 'compile':
+            self.graphs.setdefault(tuple(img.shape), self.compiled)
+            return self.compiled(img)
+        return self._get_graph(tuple(img.shape))(img)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(mode={self.mode}, shapes={list(self.graphs)})'
@@ -0,0 +1,160 @@
+import cv2
+import numpy as np
+from functools import cached_property
+from skimage import morphology as morph
+from skimage import measure
+
+# Gaps closed in a vessel map are only filled in if they are long and thin, i.e.
+# at least MIN_GAP_AREA pixels, MIN_GAP_ECCENTRICITY and at most MAX_GAP_WIDTH wide
+MIN_GAP_AREA = 10
+MIN_GAP_ECCENTRICITY = 0.95
+MAX_GAP_WIDTH = 5
+
+# Tolerance within which a gap's shape is re-checked with skimage's regionprops
+_SHAPE_TOL = 1e-6
+
+
+def _gap_shapes(labels, n_labels, area):
+    """
+    Eccentricity and minor axis length of every labelled region, as in skimage's regionprops,
+    from its central second moments accumulated over all regions at once.
+    """
+    rows, cols = np.nonzero(labels)
+    lab = labels[rows, cols]
+    n = np.maximum(area, 1).astype(np.float64)
+    cr = np.bincount(lab, rows, minlength=n_labels) / n
+    cc = np.bincount(lab, cols, minlength=n_labels) / n
+    dr = rows - cr[lab]
+    dc = cols - cc[lab]
+    mu20 = np.bincount(lab, dr*dr, minlength=n_labels)
+    mu02 = np.bincount(lab, dc*dc, minlength=n_labels)
+    mu11 = np.bincount(lab, dr*dc, minlength=n_labels)
+
+    # Inertia tensor and its eigenvalues, largest first
+    T = np.stack([np.stack([mu02/n, -mu11/n], -1), np.stack([-mu11/n, mu20/n], -1)], -2)
+    eigvals = np.clip(np.linalg.eigvalsh(T), 0, None)
+    l2, l1 = eigvals[:, 0], eigvals[:, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eccentricity = np.where(l1 == 0, 0, np.sqrt(1 - l2 / l1))
+    minor_length = 4*np.sqrt(l2)
+
+    return eccentricity, minor_length
+
+
+def process_slomap(im, strel = morph.disk(5), hole_size = 10, object_size = 150):
+    """
+    Post-process the resulting slo vessel map to promote connectivity.
+
+    Gaps closed by a morphological closing of the map are filled in if they are long and
+    thin. Region statistics are computed with OpenCV's connected components and vectorised
+    moments rather than per region, giving the same output as skimage.
+    """
+    im = np.asarray(im) > 0
+    if not im.any():
+        return np.zeros(im.shape)
+    im = im.astype(np.uint8)
+    imc = cv2.morphologyEx(im, cv2.MORPH_CLOSE, np.asarray(strel, dtype=np.uint8))
+    imdiff = np.bitwise_xor(im, imc)
+
+    # Shape of every gap filled by closing
+    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(imdiff, connectivity=8, ltype=cv2.CV_32S)
+    area = stats[:, cv2.CC_STAT_AREA]
+    eccentricity, minor_length = _gap_shapes(labels, n_labels, area)
+    keep = (area >= MIN_GAP_AREA) & (eccentricity >= MIN_GAP_ECCENTRICITY) & (minor_length <= MAX_GAP_WIDTH)
+    keep[0] = False
+
+    # Gaps lying on a threshold to within floating point error are re-checked exactly
+    borderline = (area >= MIN_GAP_AREA) & ((np.abs(eccentricity - MIN_GAP_ECCENTRICITY) < _SHAPE_TOL) 
+                                           | (np.abs(minor_length - MAX_GAP_WIDTH) < _SHAPE_TOL))
+    for label in np.flatnonzero(borderline[1:]) + 1:
+        x, y, w, h = stats[label, :4]
+        region = measure.regionprops((labels[y:y+h, x:x+w] == label).astype(np.uint8))[0]
+        keep[label] = (region.eccentricity >= MIN_GAP_ECCENTRICITY) and (region.axis_minor_length <= MAX_GAP_WIDTH)
+    im_out = im | keep[labels].astype(np.uint8)
+
+    # Fill small holes, then remove small objects, both 4-connected
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(1 - im_out, connectivity=4, ltype=cv2.CV_32S)
+    small = stats[:, cv2.CC_STAT_AREA] < hole_size
+    small[0] = False
+    im_out[small[labels]] = 1
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(im_out, connectivity=4, ltype=cv2.CV_32S)
+    small = stats[:, cv2.CC_STAT_AREA] < object_size
+    small[0] = False
+    im_out[small[labels]] = 0
+
+    return im_out*1.
+
+
+def upsample_mask(mask, img_shape):
+    """
+    Resize a (M,N) binary mask, or (M,N,C) label mask, to native img_shape with nearest
+    neighbour interpolation, so labels are never mixed across boundaries.
+    """
+    if tuple(mask.shape[:2]) == tuple(img_shape):
+        return mask
+    out = cv2.resize(mask.astype(np.uint8), (img_shape[1], img_shape[0]), interpolation=cv2.INTER_NEAREST)
+    return out.reshape(*img_shape, *mask.shape[2:]).astype(mask.dtype)
+
+
+def _fit_ellipse(mask, get_contours=False):
+
+    # fit minimum area ellipse around disc
+    _, thresh = cv2.threshold(mask, 127, 255, 1)
+    contours, _ = cv2.findContours(thresh, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    cnt = contours[0]
+    if get_contours:
+        return cnt
+    ellipse = cv2.fitEllipse(cnt)
+    new_mask = cv2.ellipse(np.zeros_like(mask), ellipse, (255,255,255), -1)/255
+
+    return new_mask
+
+
+class OpticDisc:
+    """
+    Optic disc analysis of a binary mask, labelling it once. centre (x,y) and radius, the mean
+    of its semi-axes, are those of the first region found, both None if there is none. The
+    boundary and ellipse contour used for plotting are only computed when accessed.
+
+    If single_region, od_mask is known to hold one connected region and is not labelled. If
+    largest, as for a raw prediction, only the largest region is kept and filled by its convex
+    hull, mask then being this filled binary mask.
+    """
+    def __init__(self, od_mask, single_region=False, largest=False):
+        self.mask = od_mask
+        labels = (od_mask > 0).astype(np.uint8) if single_region else measure.label(od_mask)
+        regions = measure.regionprops(labels)
+        if largest and len(regions) > 0:
+            region = max(regions, key=lambda x: x.area)
+            self.mask = np.zeros(od_mask.shape, dtype=np.uint8)
+            self.mask[region.slice] = region.image_convex
+            regions = measure.regionprops(self.mask)
+        self.region = regions[0] if len(regions) > 0 else None
+        self.centre = None
+        self.radius = None
+        if self.region is not None:
+            self.centre = np.array(self.region.centroid).astype(int)[[1,0]]
+            self.radius = int((self.region.axis_minor_length + self.region.axis_major_length)/4)
+
+    @property
+    def detected(self):
+        return self.region is not None
+
+    @cached_property
+    def boundary(self):
+        from skimage import segmentation
+        return segmentation.find_boundaries(self.mask)
+
+    @cached_property
+    def contour(self):
+        """(n,2) points along the optic disc's contour, empty if not detected"""
+        if not self.detected:
+            return np.zeros((0, 2), dtype=int)
+        return _fit_ellipse((255*self.mask).astype(np.uint8), get_contours=True)[:,0]
+
+    def ellipse(self):
+        """Binary mask of the minimum area ellipse fitted around the optic disc"""
+        return _fit_ellipse((255*self.mask).astype(np.uint8))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(centre={self.centre}, radius={self.radius})'
@@ -0,0 +1,77 @@
+import numpy as np
+import torch
+from pathlib import PurePath, PosixPath
+from PIL import Image, ImageOps
+from skimage import exposure
+from torchvision.transforms import v2 as T
+
+MODEL_SIZE = (768, 768)
+
+
+def load_uint8(img):
+    """
+    Decode an image path, numpy array or torch tensor into a single-channel
+    uint8 array.
+
+    Paths are read as grayscale without rescaling, while arrays and tensors are
+    rescaled to [0,255], matching the PIL round trip previously done per segmenter.
+    """
+    if isinstance(img, (str, PurePath, PosixPath)):
+        return np.array(ImageOps.grayscale(Image.open(img)))
+
+    if isinstance(img, torch.Tensor):
+        img = img.detach().cpu().numpy()
+    if not isinstance(img, np.ndarray):
+        raise TypeError(f"Unknown image type {type(img).__name__}, must be either string/filepath/numpy array/torch tensor.")
+
+    # Drop singleton batch and channel axes only, so 1xN and Nx1 images keep their shape.
+    # Colour inputs fall back to PIL's grayscale conversion
+    while img.ndim > 3 and img.shape[0] == 1:
+        img = img[0]
+    if img.ndim == 3 and img.shape[-1] == 1:
+        img = img[..., 0]
+    elif img.ndim == 3 and img.shape[0] == 1:
+        img = img[0]
+    img = exposure.rescale_intensity(img, in_range='image', out_range=(0,255))
+    if img.ndim == 3:
+        return np.array(ImageOps.grayscale(Image.fromarray(img.astype(np.uint8))))
+
+    # As PIL, which holds floats in 32-bit 'F' mode and truncates them to 8-bit grayscale,
+    # so 147.99999 rounds to 148 in float32 before truncating
+    if np.issubdtype(img.dtype, np.floating):
+        img = img.astype(np.float32)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+class PreparedImg:
+    """
+    Decoded uint8 SLO image, shared by SLOSegmenter, FOVSegmenter and AVOSegmenter.
+
+    The image is decoded once and resized once to the model resolution, and each
+    segmenter only applies its own dtype conversion/normalisation on top.
+    """
+    def __init__(self, img, size=MODEL_SIZE):
+        self.native = torch.from_numpy(load_uint8(img)).unsqueeze(0)
+        self.shape = tuple(self.native.shape[-2:])
+        self.size = tuple(size)
+        self._resized = {}
+
+    def resized(self, size=None):
+        """(1,H,W) uint8 tensor at model resolution, cached per size"""
+        size = self.size if size is None else tuple(size)
+        if size not in self._resized:
+            if size == self.shape:
+                self._resized[size] = self.native
+            else:
+                self._resized[size] = T.Resize(size, antialias=True)(self.native)
+        return self._resized[size]
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(shape={self.shape}, size={self.size})'
+
+
+def prepare_img(img, size=MODEL_SIZE):
+    """Decode and resize img once, passing through already prepared images"""
+    if isinstance(img, PreparedImg):
+        return img
+    return PreparedImg(img, size=size)
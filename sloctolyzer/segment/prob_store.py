@@ -0,0 +1,88 @@
+import os
+import hashlib
+import numpy as np
+import torch
+from sloctolyzer.segment import registry
+
+STORE_DTYPES = [np.float16, np.float32]
+
+
+class ProbabilityStore:
+    """
+    On-disk store of segmentation models' output probabilities, keyed by a hash of the
+    image's pixels and of the model, i.e. its weights' checksum and every setting that
+    changes its output. Probabilities are those before resizing to native resolution and
+    thresholding, so re-running with a different threshold or post-processing skips the
+    models entirely.
+
+    Each map is saved as a dtype .npy file, float16 by default, and memory-mapped when loaded,
+    so it is only read from disk as it is used. The segmenters post-process stored maps at this
+    precision, including when they are first saved, so re-runs give the same masks.
+    """
+    def __init__(self, directory, dtype=np.float16):
+        if dtype not in STORE_DTYPES:
+            raise ValueError(f"Unsupported dtype {dtype}, must be one of {STORE_DTYPES}.")
+        self.directory = directory
+        self.dtype = dtype
+        os.makedirs(directory, exist_ok=True)
+
+    def model_key(self, segmenter):
+        """Hash of a segmenter's weights and output-changing settings, computed once and kept on the segmenter"""
+        key = getattr(segmenter, 'prob_store_key', None)
+        if key is None:
+            settings = [segmenter.__class__.__name__,
+                        registry.checksum(segmenter.weights_path),
+                        segmenter.backend,
+                        segmenter.bf16,
+                        segmenter.tile_size,
+                        segmenter.tile_overlap if segmenter.tile_size is not None else None,
+                        getattr(segmenter, 'fast_size', None)]
+            key = hashlib.sha256(repr(settings).encode()).hexdigest()
+            segmenter.prob_store_key = key
+        return key
+
+    def _path(self, img, segmenter):
+        """Location of the probabilities of a PreparedImg from segmenter"""
+        native = img.native.numpy()
+        img_key = hashlib.sha256(repr(native.shape).encode() + native.tobytes()).hexdigest()
+        model_key = self.model_key(segmenter)
+        return os.path.join(self.directory, model_key[:16], img_key[:2], f"{img_key}.npy")
+
+    def contains(self, img, segmenter):
+        return os.path.exists(self._path(img, segmenter))
+
+    def load(self, img, segmenter):
+        """
+        Stored probabilities as a tensor of the stored dtype, memory-mapped from disk, or None if
+        img has not been segmented. Cast with .float() where float32 is needed.
+        """
+        path = self._path(img, segmenter)
+        if not os.path.exists(path):
+            return None
+        # Copy-on-write, as torch needs a writable array, so the file itself is never modified
+        return torch.from_numpy(np.load(path, mmap_mode='c'))
+
+    def save(self, img, segmenter, probs):
+        """
+        Store a probability tensor, written to a temporary file first so partial writes are never
+        read. Returns the probabilities as stored, i.e. on CPU and rounded to the stored dtype.
+        """
+        path = self._path(img, segmenter)
+        save_dir = os.path.dirname(path)
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir, exist_ok=True)
+        tmp_path = f"{path[:-4]}.{os.getpid()}.tmp.npy"
+        probs = probs.detach().cpu().numpy().astype(self.dtype)
+        np.save(tmp_path, probs)
+        os.replace(tmp_path, path)
+        return torch.from_numpy(probs)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.directory}, dtype={np.dtype(self.dtype).name})'
+
+
+def get_store(prob_store):
+    """ProbabilityStore from a directory, passing through an existing store or None"""
+    if prob_store is None or isinstance(prob_store, ProbabilityStore):
+        return prob_store
+    return ProbabilityStore(prob_store)
@@ -0,0 +1,136 @@
+import os
+import copy
+import argparse
+import torch
+from tqdm.autonotebook import tqdm
+from sloctolyzer.segment.preprocess import prepare_img
+from sloctolyzer.segment import validate
+
+SCRIPT_PATH = os.path.realpath(os.path.dirname(__file__))
+QUANT_ENGINE = 'x86'
+
+
+def _set_engine(engine=QUANT_ENGINE):
+    """Select the quantized kernel engine, falling back to fbgemm on older PyTorch"""
+    engines = torch.backends.quantized.supported_engines
+    if engine not in engines:
+        engine = 'fbgemm' if 'fbgemm' in engines else engines[-1]
+    torch.backends.quantized.engine = engine
+    return engine
+
+
+def _calibration_inputs(segmenter, img_list):
+    """Model inputs for img_list, transformed exactly as in predict_img"""
+    inputs = []
+    for img in img_list:
+        img = segmenter.transform(prepare_img(img).resized())
+        img = img[0] if isinstance(img, tuple) else img
+        inputs.append(img.unsqueeze(0).cpu())
+    return inputs
+
+
+def _unwrap(model):
+    """The nn.Module under any FastModel/CompiledModel wrappers"""
+    while not isinstance(model, torch.nn.Module) or hasattr(model, 'model'):
+        model = model.model
+    return model
+
+
+def _drop_identities(model):
+    """
+    Remove the Identity modules left in each nn.Sequential by optimise.fuse_model, so that
+    FX sees each Conv2d directly followed by its ReLU and fuses them into one quantized op.
+    """
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, torch.nn.Sequential) and any(isinstance(m, torch.nn.Identity) for m in child):
+                setattr(module, name, torch.nn.Sequential(*[m for m in child if not isinstance(m, torch.nn.Identity)]))
+    return model
+
+
+def quantize_model(model, calibration_inputs, engine=QUANT_ENGINE):
+    """
+    Static post-training INT8 quantization of a UNet with FX graph mode. Activation ranges
+    are observed on calibration_inputs, and the result is traced and frozen with TorchScript.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    engine = _set_engine(engine)
+    model = _drop_identities(copy.deepcopy(model).cpu().eval())
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+
+    example = calibration_inputs[0]
+    prepared = prepare_fx(model, qconfig_mapping, example_inputs=(example,))
+    with torch.no_grad():
+        for img in tqdm(calibration_inputs, desc='Calibrating', leave=False):
+            prepared(img)
+        quantized = convert_fx(prepared)
+        quantized = torch.jit.freeze(torch.jit.trace(quantized, example))
+
+    return quantized
+
+
+def load_int8_model(int8_model_path):
+    """Load a TorchScript INT8 model saved by quantize_segmenter"""
+    _set_engine()
+    return torch.jit.load(int8_model_path, map_location='cpu')
+
+
+def quantize_segmenter(segmenter, calibration_list, save_path, min_dice=0.95):
+    """
+    Quantize a float SLOSegmenter, AVOSegmenter or FOVSegmenter to INT8 using the images
+    in calibration_list, save it to save_path and report Dice agreement against the float
+    model on the same images.
+
+    Returns whether every class' mean Dice is at least min_dice, and the per-image Dice scores.
+    """
+    model = _unwrap(segmenter.model)
+    calibration_inputs = _calibration_inputs(segmenter, calibration_list)
+    quantized = quantize_model(model, calibration_inputs)
+
+    save_dir = os.path.dirname(os.path.abspath(save_path))
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    torch.jit.save(quantized, save_path)
+
+    int8_segmenter = segmenter.__class__(threshold=segmenter.threshold,
+                                         backend='int8',
+                                         int8_model_path=save_path)
+    dices = validate.compare_predictions(segmenter, int8_segmenter, calibration_list)
+    accepted = validate.print_dice_report(segmenter.__class__.__name__, dices, min_dice)
+    if not accepted:
+        print(f"    Quantized model saved to {save_path} but should not be used.")
+
+    return accepted, dices
+
+
+def quantize_segmenters(calibration_list, save_directory, min_dice=0.95):
+    """
+    Quantize SLOSegmenter, AVOSegmenter and FOVSegmenter to INT8, saving each to save_directory,
+    to be loaded with backend='int8' and int8_model_path=... on each segmenter.
+    """
+    from sloctolyzer.segment import slo_inference, avo_inference, fov_inference
+    segmenters = [slo_inference.SLOSegmenter(), avo_inference.AVOSegmenter(), fov_inference.FOVSegmenter()]
+
+    results = {}
+    for name, segmenter in zip(["slosegmenter", "avosegmenter", "fovsegmenter"], segmenters):
+        save_path = os.path.join(save_directory, f"{name}_weights_int8.pt")
+        results[name] = quantize_segmenter(segmenter, calibration_list, save_path, min_dice)[0]
+
+    return results
+
+
+# Once called from terminal
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantize SLOctolyzer's segmentation models to INT8 for CPU inference.")
+    parser.add_argument("calibration_directory", help="Directory of SLO images to calibrate and validate with.")
+    parser.add_argument("save_directory", nargs="?", default=os.path.join(SCRIPT_PATH, "weights"),
+                        help="Directory to save the INT8 models to.")
+    parser.add_argument("--min_dice", type=float, default=0.95,
+                        help="Minimum mean Dice against the float model to accept a quantized model.")
+    args = parser.parse_args()
+
+    img_types = (".bmp", ".png", ".tif", ".jpg", ".jpeg")
+    calibration_list = sorted(os.path.join(args.calibration_directory, f) for f in os.listdir(args.calibration_directory)
+                              if f.lower().endswith(img_types))
+    quantize_segmenters(calibration_list, args.save_directory, args.min_dice)
@@ -0,0 +1,248 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+import argparse
+from pathlib import Path
+import torch
+import torch.nn as nn
+from sloctolyzer.segment import checkpoint
+
+CACHE_ENV = 'SLOCTOLYZER_CACHE'
+OFFLINE_ENV = 'SLOCTOLYZER_OFFLINE'
+DEFAULT_CACHE_DIR = os.path.join(Path.home(), '.cache', 'sloctolyzer')
+MANIFEST = 'manifest.json'
+# Held while updating the manifest, as segmenters may be loaded on several threads at once
+_MANIFEST_LOCK = threading.Lock()
+RELEASE_URL = 'https://github.com/jaburke166/SLOctolyzer/releases/download/v1.0'
+MODELS = {'slosegmenter': f'{RELEASE_URL}/slosegmenter_weights.pth',
+          'avosegmenter': f'{RELEASE_URL}/avosegmenter_weights.pth',
+          'fovsegmenter': f'{RELEASE_URL}/fovsegmenter_weights.pth'}
+# Lite weights are smaller student models distilled locally with sloctolyzer/segment/distill.py
+TIERS = ['full', 'lite']
+
+
+def get_cache_dir(cache_dir=None):
+    """Weight cache directory, from cache_dir, the SLOCTOLYZER_CACHE environment variable or ~/.cache/sloctolyzer"""
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_ENV, DEFAULT_CACHE_DIR)
+    return cache_dir
+
+
+def is_offline():
+    """Whether SLOCTOLYZER_OFFLINE is set, so missing weights raise rather than download"""
+    return os.environ.get(OFFLINE_ENV, '0').lower() not in ['0', 'false', '']
+
+
+def sha256sum(path, chunk_size=2**20):
+    """SHA-256 hex digest of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(cache_dir=None):
+    """Filename to SHA-256, size and modification time of installed weights"""
+    manifest_path = os.path.join(get_cache_dir(cache_dir), MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    # Manifests written before sizes and times were recorded only hold the SHA-256
+    return {fname: {'sha256': entry} if isinstance(entry, str) else entry for (fname, entry) in manifest.items()}
+
+
+def _save_manifest(manifest, cache_dir=None):
+    manifest_path = os.path.join(get_cache_dir(cache_dir), MANIFEST)
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _record(path, checksum, cache_dir=None):
+    """Record the SHA-256, size and modification time of an installed file in the manifest"""
+    stat = os.stat(path)
+    with _MANIFEST_LOCK:
+        manifest = load_manifest(cache_dir)
+        manifest[os.path.basename(path)] = {'sha256': checksum, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        _save_manifest(manifest, cache_dir)
+
+
+def verify(path, cache_dir=None):
+    """Check a cached weights file against the SHA-256 recorded when it was installed, hashing the whole file"""
+    fname = os.path.basename(path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{fname} is not installed in {get_cache_dir(cache_dir)}.")
+    entry = load_manifest(cache_dir).get(fname)
+    if entry is None:
+        raise ValueError(f"{fname} has no recorded checksum in {get_cache_dir(cache_dir)}. Reinstall it with 'python -m sloctolyzer.segment.registry install'.")
+    if sha256sum(path) != entry['sha256']:
+        raise ValueError(f"Checksum mismatch for {path}, the file may be corrupted. Reinstall it with 'python -m sloctolyzer.segment.registry install'.")
+    return path
+
+
+def check(path, cache_dir=None):
+    """
+    Quick check of a cached weights file against the size and modification time recorded when
+    it was installed, so loading does not hash the whole file. Files whose size or time differ,
+    or were installed before these were recorded, are hashed in full with verify() instead.
+    """
+    entry = load_manifest(cache_dir).get(os.path.basename(path))
+    if entry is not None and os.path.exists(path):
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime_ns) == (entry.get('size'), entry.get('mtime_ns')):
+            return path
+    verify(path, cache_dir)
+    # Content is unchanged, so only the recorded size and time are updated
+    _record(path, entry['sha256'], cache_dir)
+    return path
+
+
+def checksum(path, cache_dir=None):
+    """SHA-256 of weights, as recorded in the manifest if installed in the cache, otherwise computed"""
+    fname = os.path.basename(path)
+    cache_dir = get_cache_dir(cache_dir)
+    if os.path.dirname(os.path.abspath(path)) == os.path.abspath(cache_dir):
+        entry = load_manifest(cache_dir).get(fname)
+        if entry is not None:
+            return entry['sha256']
+    return sha256sum(path)
+
+
+def unfused_path(path):
+    """Path of the unfused copy of installed weights, e.g. slosegmenter_weights_unfused.pth"""
+    root, ext = os.path.splitext(path)
+    return f'{root}_unfused{ext}'
+
+
+def install(url, cache_dir=None, source_directory=None, progress=True):
+    """
+    Install weights into the cache, downloading from url or copying the file of the same
+    name from source_directory, e.g. for air-gapped machines, and record its SHA-256.
+    UNets are converted to memory-mappable checkpoints as they are installed, with their
+    BatchNorms folded so the default fuse_bn=True load stays memory-mapped, and an unfused
+    copy is installed alongside for fuse_bn=False.
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    fname = os.path.basename(url)
+    path = os.path.join(cache_dir, fname)
+    if source_directory is not None:
+        src_path = os.path.join(source_directory, fname)
+    else:
+        src_path = path + '.download'
+        torch.hub.download_url_to_file(url, src_path, progress=progress)
+    paths = [path]
+    try:
+        model = checkpoint.load_model(src_path)
+        # Saved unfused first, as fusing folds the model's BatchNorms in place
+        if any(isinstance(module, nn.BatchNorm2d) for module in model.modules()):
+            paths.append(checkpoint.save_checkpoint(model, unfused_path(path), fuse_bn=False))
+        checkpoint.save_checkpoint(model, path, fuse_bn=True)
+    except ValueError:
+        # Not a UNet
+        shutil.copyfile(src_path, path)
+    if len(paths) == 1 and os.path.exists(unfused_path(path)):
+        # Left over from a previous install with BatchNorms
+        os.remove(unfused_path(path))
+    if source_directory is None:
+        os.remove(src_path)
+
+    for installed_path in paths:
+        _record(installed_path, sha256sum(installed_path), cache_dir)
+
+    return path
+
+
+def tier_url(url, tier='full'):
+    """URL of a model's weights at the given tier, e.g. slosegmenter_weights_lite.pth for 'lite'"""
+    if tier not in TIERS:
+        raise ValueError(f"Unknown model tier {tier}, must be one of {TIERS}.")
+    if tier == 'full':
+        return url
+    root, ext = os.path.splitext(url)
+    return f'{root}_{tier}{ext}'
+
+
+def resolve_weights(url, cache_dir=None, offline=None, tier='full', fuse_bn=True):
+    """
+    Local path to checked weights for url. Weights already in the cache are used without
+    any network access, after a quick size and modification time check against the manifest.
+    Otherwise they are downloaded and installed, unless offline (or SLOCTOLYZER_OFFLINE is
+    set), in which case a FileNotFoundError is raised immediately. Lite tier weights are never
+    downloaded, they must first be distilled and installed. If not fuse_bn, the unfused copy
+    is returned where one is installed.
+    """
+    if offline is None:
+        offline = is_offline()
+    url = tier_url(url, tier)
+    path = os.path.join(get_cache_dir(cache_dir), os.path.basename(url))
+    if tier == 'lite' and not os.path.exists(path):
+        raise FileNotFoundError(f"{os.path.basename(url)} is not installed in {get_cache_dir(cache_dir)}. Distill it with 'python -m sloctolyzer.segment.distill <image_directory>'.")
+    if not os.path.exists(path):
+        # Weights previously downloaded by torch.hub are installed from its cache
+        hub_directory = os.path.join(torch.hub.get_dir(), 'checkpoints')
+        if os.path.exists(os.path.join(hub_directory, os.path.basename(url))):
+            install(url, cache_dir, source_directory=hub_directory)
+        elif offline:
+            raise FileNotFoundError(f"{os.path.basename(url)} is not installed in {get_cache_dir(cache_dir)} and SLOctolyzer is offline. Install it with 'python -m sloctolyzer.segment.registry install'.")
+        else:
+            print(f"Downloading {os.path.basename(url)} to {get_cache_dir(cache_dir)}.")
+            install(url, cache_dir)
+    if not fuse_bn and os.path.exists(unfused_path(path)):
+        path = unfused_path(path)
+
+    return check(path, cache_dir)
+
+
+def install_all(cache_dir=None, source_directory=None):
+    """Prefetch weights for every segmenter into the cache"""
+    for name, url in MODELS.items():
+        path = install(url, cache_dir, source_directory)
+        print(f"Installed {name} to {path}")
+
+
+def verify_all(cache_dir=None):
+    """Verify every segmenter's cached weights, returning True if all are installed and intact"""
+    intact = True
+    for name, url in MODELS.items():
+        path = os.path.join(get_cache_dir(cache_dir), os.path.basename(url))
+        lite_path = os.path.join(get_cache_dir(cache_dir), os.path.basename(tier_url(url, 'lite')))
+        # Lite and unfused weights are only verified if installed
+        optional = [(f"{name} (lite)", lite_path), (f"{name} (unfused)", unfused_path(path)),
+                    (f"{name} (lite, unfused)", unfused_path(lite_path))]
+        for label, optional_path in optional:
+            if os.path.exists(optional_path):
+                try:
+                    verify(optional_path, cache_dir)
+                    print(f"{label}: OK")
+                except ValueError as e:
+                    print(f"{label}: {e}")
+                    intact = False
+        try:
+            verify(path, cache_dir)
+            print(f"{name}: OK")
+        except (ValueError, FileNotFoundError) as e:
+            print(f"{name}: {e}")
+            intact = False
+    return intact
+
+
+# Once called from terminal
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage SLOctolyzer's local model weight cache.")
+    parser.add_argument("command", choices=["install", "verify"],
+                        help="install: prefetch all weights into the cache. verify: check cached weights against their checksums.")
+    parser.add_argument("--cache_dir", default=None,
+                        help=f"Cache directory, defaults to ${CACHE_ENV} or {DEFAULT_CACHE_DIR}.")
+    parser.add_argument("--source", default=None,
+                        help="Directory of already downloaded weight files to install from, instead of downloading.")
+    args = parser.parse_args()
+    if args.command == "install":
+        install_all(args.cache_dir, args.source)
+    elif not verify_all(args.cache_dir):
+        raise SystemExit(1)
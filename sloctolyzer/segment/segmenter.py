@@ -0,0 +1,245 @@
+import os
+import torch
+from tqdm.autonotebook import tqdm
+from torch.utils.data import DataLoader, Dataset
+from sloctolyzer.segment.preprocess import prepare_img
+from sloctolyzer.segment.prob_store import get_store
+from sloctolyzer.segment import onnx_backend, optimise, quantize, tiling, registry, checkpoint, threads, buffers
+
+BACKENDS = ['torch', 'onnx', 'int8']
+
+
+def transform_img(transform, img):
+    """Apply a segmenter's transform, returning the model input and its unpadded (M,N)"""
+    x = transform(img)
+    return x if isinstance(x, tuple) else (x, tuple(x.shape[-2:]))
+
+
+class ImgListDataset(Dataset):
+    """Torch Dataset from img list, of any mix of resolutions, resized to size and transformed"""
+    def __init__(self, img_list, transform, size=None):
+        self.img_list = img_list
+        self.transform = transform
+        self.size = size
+
+    def __len__(self):
+        return len(self.img_list)
+
+    def __getitem__(self, idx):
+        img = prepare_img(self.img_list[idx])
+        shape = img.shape
+        img, crop = transform_img(self.transform, img.resized(self.size))
+        return {'img': img, "crop":crop, "shape":shape}
+
+
+def get_img_list_dataloader(img_list, transform, size=None, batch_size=16, num_workers=0, pin_memory=False):
+    """Wrapper of Dataset into DataLoader"""
+    dataset = ImgListDataset(img_list, transform, size)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                        pin_memory=pin_memory)
+    return loader
+
+
+class Segmenter:
+    """
+    Model loading and inference shared by SLOSegmenter, AVOSegmenter and FOVSegmenter. Each
+    sets its transform, the model input of its buffer pool and its own post-processing.
+
+    Inputs:
+    -------------------
+    model_path (str) : URL of the default weights, resolved from the local weight cache.
+
+    threshold (float) : Probability threshold of the segmentation masks.
+
+    local_model_path (str) : Local weights to load instead of model_path.
+
+    backend (str) : 'torch', 'onnx' to run the model with onnxruntime on CPU, loading onnx_path
+                    if it exists and otherwise exporting the PyTorch model to it first, or once
+                    into the weight cache if onnx_path is not given, or 'int8' to run a
+                    statically quantized CPU model saved at int8_model_path, see quantize.py.
+
+    fuse_bn (bool) : Fold each BatchNorm into its preceding convolution, for the PyTorch and ONNX
+                     backends, giving the same outputs with fewer passes over memory. Cached weights
+                     are installed already folded, so stay memory-mapped, and False loads their
+                     unfused copy. Weights from local_model_path are folded at load time.
+
+    channels_last, bf16 (bool) : Run the PyTorch model in channels-last memory format and under
+                                 bfloat16 autocast, if the CPU supports it (AVX512-BF16/AMX). Check
+                                 the deviation from float32 with validate.compare_soft_predictions.
+
+    compile_mode (str) : 'script' or 'compile' freezes the PyTorch model with TorchScript or
+                         torch.compile, compiling once per input shape and warming up on warmup_shapes.
+
+    tile_size (int) : e.g. 768, segments images at native resolution rather than resizing them to
+                      (768,768), using overlapping tiles blended over tile_overlap pixels,
+                      tiles_in_flight tiles per forward pass. Model memory no longer depends on image size.
+
+    num_threads (int) : Threads used for inference, e.g. the cores per worker when running several
+                        workers on one machine, see threads.py.
+
+    prob_store (str) : Directory (or ProbabilityStore) in which the model's probabilities are saved
+                       per image, so images already segmented with the same model are not run
+                       again, e.g. when changing threshold. See prob_store.py.
+
+    tier (str) : 'lite' loads a smaller, faster but less accurate student model distilled from the
+                 default one, from the local weight cache. See distill.py.
+
+    buffer_pool (bool) : Reuse preallocated input, resized probability and mask buffers per shape
+                         across calls to predict_img, pinned if on GPU. A segmenter with a buffer
+                         pool should only be used by one thread at a time.
+    """
+    # Shown when loaded on GPU
+    NAME = 'Segmentation'
+    # Output channels kept from the model, an int dropping the channel axis
+    CHANNELS = slice(None)
+    # Keyword arguments of BufferPool.input reproducing the transform
+    BUFFER_INPUT = {'factor': 32}
+
+    def __init__(self, model_path, threshold, local_model_path=None,
+                 backend='torch', onnx_path=None, int8_model_path=None,
+                 fuse_bn=True, channels_last=False, bf16=False, compile_mode=None, warmup_shapes=optimise.DEFAULT_WARMUP_SHAPES,
+                 tile_size=None, tile_overlap=tiling.TILE_OVERLAP, tiles_in_flight=tiling.TILES_IN_FLIGHT,
+                 num_threads=None, prob_store=None, tier='full', buffer_pool=False):
+        self.threshold = threshold
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tiles_in_flight = tiles_in_flight
+        self.bf16 = bf16
+        # Resolution the model runs at, None for (768,768)
+        self.input_size = None
+        self.prob_store = get_store(prob_store)
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend}, must be one of {BACKENDS}.")
+        self.backend = backend
+        if num_threads is not None and backend != 'onnx':
+            threads.set_thread_budget(num_threads)
+        self.device = 'cuda' if torch.cuda.is_available() and backend == 'torch' else 'cpu'
+        #self.device = "mps" if torch.backends.mps.is_available() else "cpu"
+
+        # A previously exported ONNX graph does not need the PyTorch model loading
+        if backend == 'onnx' and onnx_path is not None and os.path.exists(onnx_path):
+            self.model = onnx_backend.ONNXModel(onnx_path, num_threads=num_threads)
+            self.weights_path = onnx_path
+        elif backend == 'int8':
+            if int8_model_path is None:
+                raise ValueError("backend='int8' requires int8_model_path, created with sloctolyzer/segment/quantize.py.")
+            self.model = quantize.load_int8_model(int8_model_path)
+            self.weights_path = int8_model_path
+        else:
+            if local_model_path is not None:
+                self.weights_path = local_model_path
+            else:
+                # Resolved from the local weight cache, only downloading if not yet installed
+                self.weights_path = registry.resolve_weights(model_path, tier=tier, fuse_bn=fuse_bn)
+            self.model = checkpoint.load_model(self.weights_path, map_location=self.device)
+            if fuse_bn:
+                self.model = optimise.fuse_model(self.model)
+            if backend == 'onnx':
+                self.model = onnx_backend.load_onnx_model(self.model, onnx_path, num_threads=num_threads,
+                                                            weights_path=self.weights_path)
+        if self.device != "cpu":
+            print(f"{self.NAME} has been loaded with GPU acceleration!")
+        self.model.eval()
+        self.buffers = buffers.BufferPool(self.device) if buffer_pool else None
+        if backend == 'torch' and (channels_last or bf16):
+            self.model = optimise.FastModel(self.model, channels_last, bf16)
+        if compile_mode is not None and backend == 'torch':
+            self.model = optimise.CompiledModel(self.model, compile_mode, warmup_shapes)
+
+    def _predict_tiled(self, img):
+        """Sliding-window probabilities of a transformed native resolution image"""
+        return tiling.predict_tiled(self.model, img, self.tile_size, self.tile_overlap, self.tiles_in_flight)
+
+    def _predict_probs(self, img):
+        """Probabilities of a PreparedImg, before resizing to native resolution"""
+        if self.tile_size is not None:
+            x, (M, N) = transform_img(self.transform, img.native)
+            pred = self._predict_tiled(x.to(self.device))
+        elif self.buffers is not None:
+            x, (M, N) = self.buffers.input(img.resized(self.input_size), **self.BUFFER_INPUT)
+            pred = self.model(x).squeeze(0).sigmoid_()
+        else:
+            x, (M, N) = transform_img(self.transform, img.resized(self.input_size))
+            pred = self.model(x.unsqueeze(0).to(self.device)).squeeze(0).sigmoid()
+        return pred[..., self.CHANNELS, :, :][..., :M, :N]
+
+    def _get_probs(self, img):
+        """Probabilities of a PreparedImg, loaded from the store if saved there"""
+        pred = None if self.prob_store is None else self.prob_store.load(img, self)
+        if pred is None:
+            pred = self._predict_probs(img)
+            if self.prob_store is not None:
+                # Post-processed at the stored precision, so re-runs from the store give the same masks
+                pred = self.prob_store.save(img, self, pred).to(pred.device)
+        return pred.float()
+
+    @torch.inference_mode()
+    def _predict_one(self, img, *args):
+        """Post-processed inference on a single image, args passed on to _postprocess"""
+        img = prepare_img(img)
+        return self._postprocess(self._get_probs(img), img.shape, *args)
+
+    def _predict_list(self, img_list, args_list):
+        """Inference on a list of images without batching, with each image's _postprocess args"""
+        return [self._predict_one(img, *args)
+                for img, args in tqdm(zip(img_list, args_list), total=len(img_list), desc='Predicting', leave=False)]
+
+    def _get_loader(self, img_list, batch_size=16, num_workers=0, pin_memory=False):
+        """DataLoader of img_list transformed at the model's input size"""
+        return get_img_list_dataloader(img_list, self.transform, self.input_size, batch_size=batch_size,
+                                       num_workers=num_workers, pin_memory=pin_memory)
+
+    @torch.inference_mode()
+    def _predict_loader(self, loader, args_list):
+        """
+        Inference from a DataLoader. Every image is resized to (768,768), or the model's input size,
+        in the loader and resized back to its own native resolution here, so mixed resolutions work.
+        """
+        preds = []
+        for batch in tqdm(loader, desc='Predicting', leave=False):
+            pred = self.model(batch['img'].to(self.device)).sigmoid()[:, self.CHANNELS]
+            for (p, M, N, H, W) in zip(pred, *batch['crop'], *batch['shape']):
+                preds.append(self._postprocess(p[..., :M, :N], (int(H), int(W)), *args_list[len(preds)]))
+        return preds
+
+    @torch.inference_mode()
+    def _store_batch(self, img_list, batch_size=16, num_workers=0, pin_memory=False):
+        """Batched inference of PreparedImgs, saving probabilities to the store instead of post-processing"""
+        loader = self._get_loader(img_list, batch_size, num_workers, pin_memory)
+        idx = 0
+        for batch in tqdm(loader, desc='Predicting', leave=False):
+            pred = self.model(batch['img'].to(self.device)).sigmoid()[:, self.CHANNELS]
+            for (p, M, N) in zip(pred, *batch['crop']):
+                self.prob_store.save(img_list[idx], self, p[..., :M, :N])
+                idx += 1
+
+    def _predict_batch(self, img_list, args_list, batch_size=16, num_workers=0, pin_memory=False):
+        """
+        Batched inference, one post-processed prediction per image in img_list identical to
+        predict_img. If tile_size is set, tiles are batched within each image instead.
+        """
+        if self.tile_size is not None:
+            return self._predict_list(img_list, args_list)
+        if self.prob_store is not None:
+            # Only run the model on images without stored probabilities
+            img_list = [prepare_img(img) for img in img_list]
+            missing = [img for img in img_list if not self.prob_store.contains(img, self)]
+            if len(missing) > 0:
+                self._store_batch(missing, batch_size, num_workers, pin_memory)
+            return self._predict_list(img_list, args_list)
+        loader = self._get_loader(img_list, batch_size, num_workers, pin_memory)
+        return self._predict_loader(loader, args_list)
+
+    @staticmethod
+    def _unzip(outputs, soft_pred=False):
+        """Split (prediction, extra) outputs into two lists, extras None if soft_pred"""
+        if soft_pred:
+            return outputs, len(outputs)*[None]
+        return [output[0] for output in outputs], [output[1] for output in outputs]
+
+    def __call__(self, x):
+        """Direct call for inference on single  image"""
+        return self.predict_img(x)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(threshold={self.threshold}, backend={self.backend})'
@@ -0,0 +1,158 @@
+import os
+import time
+import threading
+import torch
+
+
+def available_cores():
+    """Number of CPU cores this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def set_thread_budget(num_threads=None, num_interop_threads=None):
+    """
+    Limit the threads PyTorch uses for inference in this process. When running several
+    workers on one machine, num_threads should be at most the cores per worker so they
+    do not oversubscribe the CPU. Inter-op threads can only be set before PyTorch first
+    runs in parallel, so are left unchanged if it is too late.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            pass
+    return torch.get_num_threads()
+
+
+def _candidate_threads(n_cores):
+    """Powers of two up to n_cores, and n_cores itself"""
+    candidates = {n_cores}
+    t = 1
+    while t < n_cores:
+        candidates.add(t)
+        t *= 2
+    return sorted(candidates)
+
+
+def _model_input(model, shape):
+    """Random input of shape on the model's device"""
+    device = next(model.parameters()).device if isinstance(model, torch.nn.Module) else getattr(model, 'device', 'cpu')
+    return torch.rand(shape, device=device)
+
+
+def _time_models(models, shape, n_warmup, n_runs, barrier=None):
+    """Time of n_runs forward passes of every model in models, after n_warmup passes each and waiting at barrier"""
+    inputs = [_model_input(model, shape) for model in models]
+    for model, x in zip(models, inputs):
+        for _ in range(n_warmup):
+            model(x)
+    if barrier is not None:
+        barrier.wait()
+    st = time.perf_counter()
+    for _ in range(n_runs):
+        for model, x in zip(models, inputs):
+            model(x)
+    return time.perf_counter() - st
+
+
+def _worker(models, shape, num_threads, n_warmup, n_runs, barrier, queue):
+    """Forked worker timing the models on num_threads threads, once every worker has warmed up"""
+    from sloctolyzer.workers import memory_usage
+    torch.set_num_threads(num_threads)
+    try:
+        with torch.inference_mode():
+            elapsed = _time_models(models, shape, n_warmup, n_runs, barrier)
+    except Exception:
+        # Release the other workers, and rule this split out
+        barrier.abort()
+        queue.put((float('inf'), None))
+        return
+    usage = memory_usage()
+    queue.put((elapsed, None if usage is None else usage['private']))
+
+
+def _time_workers(models, shape, num_threads, num_workers, n_warmup, n_runs):
+    """
+    Run num_workers forked processes at once, each timing the models on num_threads threads, so
+    the measurement includes their contention for cores, caches and memory bandwidth. Returns
+    the wall time of the slowest worker and the largest private memory of a worker in MB.
+    """
+    import torch.multiprocessing as mp
+    ctx = mp.get_context('fork')
+    barrier, queue = ctx.Barrier(num_workers), ctx.Queue()
+    procs = [ctx.Process(target=_worker, args=(models, shape, num_threads, n_warmup, n_runs, barrier, queue))
+             for _ in range(num_workers)]
+    # Forked from a new thread, as libgomp hangs in a child forked by a thread which has already
+    # run in parallel, e.g. while timing the models in this process
+    starter = threading.Thread(target=lambda: [proc.start() for proc in procs])
+    starter.start()
+    starter.join()
+    results = [queue.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    private = [mb for (_, mb) in results if mb is not None]
+    return max(elapsed for (elapsed, _) in results), max(private) if private else None
+
+
+@torch.inference_mode()
+def autotune(models, shape=(1, 1, 768, 768), n_cores=None, n_warmup=2, n_runs=3, verbose=True):
+    """
+    Choose how to split the host's cores between threads per worker and workers for
+    segmentation. For each candidate number of threads, n_cores // num_threads workers are
+    forked and run the forward pass of every model in models at the real input shape at the
+    same time, so throughput is measured with the workers competing for the machine rather
+    than assuming they scale perfectly. The number of workers is then capped by how many fit
+    in memory, from the private memory each one used. Without fork, e.g. on Windows, each
+    split's throughput is estimated from its latency in this process.
+
+    The latency of a single process on each number of threads is also timed, and the fastest
+    returned as run_threads, the best setting for one process analysing files in turn. The
+    calling process's threads are left unchanged. Returns a dictionary with the best
+    num_threads and num_workers, run_threads, and the timings of each candidate. Only the
+    PyTorch backend is tuned, the ONNX backend takes num_threads when it is created.
+    """
+    import torch.multiprocessing as mp
+    from sloctolyzer.workers import memory_usage, total_memory
+    if len(models) == 0:
+        raise ValueError("At least one model is needed to autotune threads.")
+    if n_cores is None:
+        n_cores = available_cores()
+    can_fork = 'fork' in mp.get_all_start_methods()
+    usage, ram = memory_usage(), total_memory()
+    free_mb = None if usage is None or ram is None else ram - usage['rss']
+
+    results = {}
+    previous = torch.get_num_threads()
+    try:
+        for num_threads in _candidate_threads(n_cores):
+            torch.set_num_threads(num_threads)
+            latency = _time_models(models, shape, n_warmup, n_runs) / n_runs
+            num_workers = n_cores // num_threads
+            private = None
+            if can_fork and num_workers > 1:
+                elapsed, private = _time_workers(models, shape, num_threads, num_workers, n_warmup, n_runs)
+            else:
+                elapsed = latency * n_runs
+            if private is not None and free_mb is not None:
+                num_workers = max(1, min(num_workers, int(free_mb // private)))
+            # Workers dropped for lack of memory are assumed to have contributed equally
+            throughput = num_workers * n_runs * shape[0] / elapsed
+            results[num_threads] = {'num_workers': num_workers,
+                                    'latency': latency,
+                                    'throughput': throughput,
+                                    'private_mb': private}
+            if verbose:
+                print(f"    {num_threads} threads x {num_workers} workers: {latency:.3f}s per pass alone, {throughput:.2f} images/s together")
+    finally:
+        torch.set_num_threads(previous)
+
+    best = max(results, key=lambda t: results[t]['throughput'])
+    run_threads = min(results, key=lambda t: results[t]['latency'])
+    if verbose:
+        print(f"Best split on {n_cores} cores: {best} threads per worker x {results[best]['num_workers']} workers. A single process is fastest on {run_threads} threads.")
+
+    return {'num_threads': best, 'num_workers': results[best]['num_workers'], 'run_threads': run_threads, 'timings': results}
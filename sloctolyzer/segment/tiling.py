@@ -0,0 +1,61 @@
+import torch
+import torch.nn.functional as F
+
+TILE_SIZE = 768
+TILE_OVERLAP = 128
+TILES_IN_FLIGHT = 4
+
+
+def _tile_starts(length, tile_size, stride):
+    """Start indexes of tiles covering length, the last tile flush with the end"""
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, stride))
+    return starts + [length - tile_size]
+
+
+def _blend_window(tile_size, overlap, device):
+    """Weights ramping up linearly over the overlap from each tile edge, so seams are blended"""
+    ramp = torch.ones(tile_size, device=device)
+    if overlap > 0:
+        edge = torch.linspace(0, 1, overlap+2, device=device)[1:-1]
+        ramp[:overlap] = edge
+        ramp[-overlap:] = edge.flip(0)
+    return ramp[:, None] * ramp[None, :]
+
+
+def predict_tiled(model, img, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, tiles_in_flight=TILES_IN_FLIGHT):
+    """
+    Sliding-window inference of a transformed (C,H,W) image at native resolution, returning
+    (n_classes,H,W) probabilities. Overlapping tile_size tiles are run through the model
+    tiles_in_flight at a time and their probabilities blended where they overlap, so model
+    memory depends on tile_size and tiles_in_flight rather than image size.
+
+    Images smaller than a tile along either dimension are edge-padded up to tile_size.
+    """
+    if tile_size % 32 != 0:
+        raise ValueError(f"tile_size must be divisible by 32, got {tile_size}.")
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f"overlap must be at least 0 and less than tile_size, got {overlap}.")
+    C, H, W = img.shape
+    pad_H, pad_W = max(tile_size - H, 0), max(tile_size - W, 0)
+    if pad_H or pad_W:
+        img = F.pad(img.unsqueeze(0), (0, pad_W, 0, pad_H), mode='replicate')[0]
+    PH, PW = img.shape[-2:]
+
+    stride = tile_size - overlap
+    corners = [(y, x) for y in _tile_starts(PH, tile_size, stride) for x in _tile_starts(PW, tile_size, stride)]
+    window = _blend_window(tile_size, overlap, img.device)
+    weights = torch.zeros((PH, PW), device=img.device)
+    probs = None
+    for i in range(0, len(corners), tiles_in_flight):
+        batch_corners = corners[i:i+tiles_in_flight]
+        tiles = torch.stack([img[:, y:y+tile_size, x:x+tile_size] for (y, x) in batch_corners])
+        pred = model(tiles).sigmoid() * window
+        if probs is None:
+            probs = torch.zeros((pred.shape[1], PH, PW), device=img.device)
+        for (p, (y, x)) in zip(pred, batch_corners):
+            probs[:, y:y+tile_size, x:x+tile_size] += p
+            weights[y:y+tile_size, x:x+tile_size] += window
+
+    return (probs / weights)[:, :H, :W]
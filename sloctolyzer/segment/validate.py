@@ -0,0 +1,165 @@
+import os
+import time
+import argparse
+import numpy as np
+from tqdm.autonotebook import tqdm
+from PIL import Image, ImageOps
+from skimage import exposure
+from sloctolyzer.segment.preprocess import prepare_img, load_uint8
+
+
+def dice_score(pred, target):
+    """Dice coefficient between two binary masks, 1 if both are empty"""
+    pred = np.asarray(pred).astype(bool)
+    target = np.asarray(target).astype(bool)
+    denom = pred.sum() + target.sum()
+    if denom == 0:
+        return 1.
+    return 2*np.logical_and(pred, target).sum() / denom
+
+
+def compare_predictions(reference, candidate, img_list, threshold=None):
+    """
+    Dice agreement between two segmenters of the same type, e.g. a float and an INT8 model,
+    computed on thresholded soft predictions of each image in img_list.
+
+    Returns an array of shape (len(img_list), n_classes), with one column per output
+    class, i.e. 1 for binary vessels/fovea and 4 for artery-vein-optic disc.
+    """
+    if threshold is None:
+        threshold = reference.threshold
+    dices = []
+    for img in tqdm(img_list, desc='Validating', leave=False):
+        ref_pred = reference.predict_img(img, soft_pred=True) > threshold
+        cand_pred = candidate.predict_img(img, soft_pred=True) > threshold
+        if ref_pred.ndim == 2:
+            ref_pred, cand_pred = ref_pred[np.newaxis], cand_pred[np.newaxis]
+        dices.append([dice_score(c, r) for (c, r) in zip(cand_pred, ref_pred)])
+
+    return np.asarray(dices)
+
+
+def compare_soft_predictions(reference, candidate, img_list):
+    """
+    Maximum absolute deviation in predicted probability between two segmenters of the same
+    type, e.g. float32 and bfloat16 inference, for each image in img_list.
+    """
+    deviations = []
+    for img in tqdm(img_list, desc='Validating', leave=False):
+        ref_pred = reference.predict_img(img, soft_pred=True)
+        cand_pred = candidate.predict_img(img, soft_pred=True)
+        deviations.append(np.abs(ref_pred - cand_pred).max())
+
+    return np.asarray(deviations)
+
+
+def compare_masks(reference, candidate, img_list):
+    """
+    Dice agreement between the post-processed masks of two segmenters of the same type, e.g.
+    with and without upsample_masks, and the mean time each took per image in img_list.
+
+    Returns an array of shape (len(img_list), n_classes), with 1 column for binary vessels
+    and 4 for artery-vein-optic disc (artery, optic disc, vein, all vessels), and the mean
+    reference and candidate times in seconds.
+    """
+    dices = []
+    ref_time, cand_time = 0, 0
+    for img in tqdm(img_list, desc='Validating', leave=False):
+        img = prepare_img(img)
+        st = time.perf_counter()
+        ref_pred = reference.predict_img(img)
+        ref_time += time.perf_counter() - st
+        st = time.perf_counter()
+        cand_pred = candidate.predict_img(img)
+        cand_time += time.perf_counter() - st
+        ref_pred, cand_pred = [p[0] if isinstance(p, tuple) else p for p in (ref_pred, cand_pred)]
+        if ref_pred.ndim == 3:
+            ref_pred, cand_pred = np.moveaxis(ref_pred, -1, 0), np.moveaxis(cand_pred, -1, 0)
+        else:
+            ref_pred, cand_pred = ref_pred[np.newaxis], cand_pred[np.newaxis]
+        dices.append([dice_score(c, r) for (c, r) in zip(cand_pred, ref_pred)])
+
+    N = max(len(img_list), 1)
+    return np.asarray(dices), ref_time / N, cand_time / N
+
+
+def pil_uint8(img):
+    """2D array decoded by the PIL round trip each segmenter used before images were shared"""
+    img = exposure.rescale_intensity(img, in_range='image', out_range=(0,255))
+    return np.array(ImageOps.grayscale(Image.fromarray(img)))
+
+
+def compare_decoding(arrays):
+    """Number of pixels of each 2D array for which load_uint8 differs from the PIL round trip"""
+    return np.asarray([(load_uint8(img) != pil_uint8(img)).sum() for img in arrays])
+
+
+def validate_decoding(img_list):
+    """
+    Check load_uint8 decodes arrays exactly as the PIL round trip, for the images in img_list
+    as float64, float32 and uint16 arrays with non-integer intensities. Returns whether every
+    pixel matched.
+    """
+    arrays = []
+    for img in img_list:
+        img = load_uint8(img).astype(np.float64)
+        arrays += [0.731*img + 0.3, (img/255).astype(np.float32), (257*img).astype(np.uint16)]
+    n_pixels = compare_decoding(arrays)
+    print(f"\nArray decoding: {n_pixels.sum()} pixels differ from the PIL round trip over {len(arrays)} arrays.")
+
+    return bool(n_pixels.sum() == 0)
+
+
+def validate_upsample_masks(img_list, min_dice=None, slo_kwargs=None, avo_kwargs=None):
+    """
+    Report the agreement and speed up of thresholding at model resolution and upsampling the
+    masks (upsample_masks=True) against resizing the probabilities, for the binary vessel and
+    artery-vein-optic disc segmenters on img_list. Returns whether each segmenter was accepted.
+    """
+    from sloctolyzer.segment import slo_inference, avo_inference
+    accepted = {}
+    for (name, Segmenter, kwargs) in [("Binary vessels", slo_inference.SLOSegmenter, slo_kwargs),
+                                      ("Artery-vein-optic disc", avo_inference.AVOSegmenter, avo_kwargs)]:
+        kwargs = {} if kwargs is None else kwargs
+        reference = Segmenter(**kwargs)
+        candidate = Segmenter(upsample_masks=True, **kwargs)
+        # Only post-processing differs, so the candidate shares the loaded model
+        candidate.model = reference.model
+        dices, ref_time, cand_time = compare_masks(reference, candidate, img_list)
+        accepted[name] = print_dice_report(f"{name}, upsample_masks", dices, min_dice)
+        print(f"    {ref_time:.3f}s per image resizing probabilities, {cand_time:.3f}s upsampling masks.")
+
+    return accepted
+
+
+def print_dice_report(name, dices, min_dice=None):
+    """
+    Print mean and worst-case Dice per class. If min_dice is specified, returns whether every
+    class' mean Dice meets it, to accept or reject the candidate model.
+    """
+    print(f"\n{name}: Dice agreement over {dices.shape[0]} images")
+    for c, class_dices in enumerate(dices.T):
+        print(f"    class {c}: mean {class_dices.mean():.4f}, min {class_dices.min():.4f}")
+    if min_dice is None:
+        return None
+    accepted = bool((dices.mean(axis=0) >= min_dice).all())
+    print(f"    {'Accepted' if accepted else 'Rejected'} at minimum mean Dice of {min_dice}.")
+
+    return accepted
+
+
+# Once called from terminal
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate array decoding against the PIL round trip, and thresholding at model resolution and upsampling masks against the default.")
+    parser.add_argument("image_directory", help="Directory of SLO images to validate on, ideally at the cohort's resolution.")
+    parser.add_argument("--min_dice", type=float, default=None,
+                        help="Minimum mean Dice against the default to accept upsampling masks.")
+    args = parser.parse_args()
+
+    img_types = (".bmp", ".png", ".tif", ".jpg", ".jpeg")
+    img_list = sorted(os.path.join(args.image_directory, f) for f in os.listdir(args.image_directory)
+                      if f.lower().endswith(img_types))
+    decoded = validate_decoding(img_list)
+    validate_upsample_masks(img_list, args.min_dice)
+    if not decoded:
+        raise SystemExit(1)
@@ -0,0 +1,88 @@
+import torch
+from sloctolyzer import analyse
+from sloctolyzer.segment import slo_inference, avo_inference, fov_inference
+
+
+class Session:
+    """
+    Loads the binary vessel, artery-vein-optic disc and fovea segmentation models once and
+    holds analysis settings, so that repeated calls to analyse() and analyse_many() from a
+    notebook or service reuse warm models instead of loading them every call.
+
+    Inputs:
+    -------------------
+    batch_size (int) : Number of images segmented together in analyse_many().
+
+    num_threads (int) : Number of threads PyTorch uses for inference. Defaults to PyTorch's own choice.
+
+    segmenter_kwargs (dict) : Keyword arguments passed to all three segmenters, e.g. backend='onnx' or buffer_pool=True.
+
+    slo_kwargs, avo_kwargs, fov_kwargs (dict) : Keyword arguments for each segmenter, overriding segmenter_kwargs,
+                                                e.g. local_model_path, onnx_path or tile_size=768, which only
+                                                SLOSegmenter and AVOSegmenter support.
+
+    verbose (bool) : Default verbosity of analyse() and analyse_many().
+    """
+    def __init__(self,
+                 batch_size=1,
+                 num_threads=None,
+                 segmenter_kwargs=None,
+                 slo_kwargs=None,
+                 avo_kwargs=None,
+                 fov_kwargs=None,
+                 verbose=True):
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.batch_size = batch_size
+        self.num_threads = torch.get_num_threads()
+        self.verbose = verbose
+
+        segmenter_kwargs = {} if segmenter_kwargs is None else segmenter_kwargs
+        self.slo_model = slo_inference.SLOSegmenter(**{**segmenter_kwargs, **(slo_kwargs or {})})
+        self.avo_model = avo_inference.AVOSegmenter(**{**segmenter_kwargs, **(avo_kwargs or {})})
+        self.fov_model = fov_inference.FOVSegmenter(**{**segmenter_kwargs, **(fov_kwargs or {})})
+
+    def analyse(self, path, save_path=None, scale=None, location=None, eye=None, **kwargs):
+        """
+        Analyse a single image/.vol file or SLO array with the session's models. Keyword arguments
+        are passed to sloctolyzer.analyse.analyse, e.g. save_images or compute_metrics.
+        """
+        kwargs.setdefault('verbose', self.verbose)
+        return analyse.analyse(path, save_path, scale, location, eye,
+                               slo_model=self.slo_model,
+                               avo_model=self.avo_model,
+                               fov_model=self.fov_model,
+                               **kwargs)
+
+    def analyse_many(self, paths, save_path=None, scales=None, locations=None, eyes=None, **kwargs):
+        """
+        Analyse a list of image/.vol files, segmenting batch_size files together. scales, locations
+        and eyes are optional lists with one entry per path, .vol files providing their own.
+
+        Returns a list with the output of analyse() for each path.
+        """
+        N = len(paths)
+        scales = N*[None] if scales is None else scales
+        locations = N*[None] if locations is None else locations
+        eyes = N*[None] if eyes is None else eyes
+        kwargs.setdefault('verbose', self.verbose)
+
+        outputs = []
+        for i in range(0, N, self.batch_size):
+            batch_paths = paths[i:i+self.batch_size]
+            loaded = len(batch_paths)*[None]
+            predictions = len(batch_paths)*[None]
+            if self.batch_size > 1:
+                loaded = [analyse.load_slo(path, verbose=False) for path in batch_paths]
+                batch_locations = [meta.get('location', loc) for ((_, meta, _), loc) in zip(loaded, locations[i:i+self.batch_size])]
+                slos = [slo for (slo, _, _) in loaded]
+                predictions = analyse.segment_batch(slos, batch_locations, self.slo_model, self.avo_model,
+                                                    self.fov_model, self.batch_size, kwargs.get('save_images', False))
+            for j, path in enumerate(batch_paths):
+                outputs.append(self.analyse(path, save_path, scales[i+j], locations[i+j], eyes[i+j],
+                                            preloaded=loaded[j], predictions=predictions[j], **kwargs))
+
+        return outputs
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(batch_size={self.batch_size}, num_threads={self.num_threads}, models=[{self.slo_model}, {self.avo_model}, {self.fov_model}])'
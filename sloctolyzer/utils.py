@@ -3,16 +3,13 @@ import skimage as sk
 import os
 import pandas as pd
 import pickle
-import matplotlib.pyplot as plt
-import SimpleITK as sitk
-import eyepy
 
 from PIL import Image, ImageOps
 from skimage import segmentation, measure, exposure
-from sklearn.linear_model import LinearRegression
 from sloctolyzer.measure import tortuosity_measures, slo_measurement
-from eyepy.core import utils as eyepy_utils
-from eyepy.io.he import vol_reader
+
+# Optional dependencies, i.e. eyepy for .vol files, SimpleITK for .nii.gz annotations, sklearn
+# and matplotlib, are imported by the functions using them so they only load when needed
 
 
 
@@ -25,6 +22,10 @@ def load_volfile(vol_path, logging=[], verbose=False):
     one with the fovea-centred B-scan acquisition location superimposed,
     and another with all B-scan acquisition locations superimposed.
     """
+    import eyepy
+    from eyepy.io.he import vol_reader
+    from sklearn.linear_model import LinearRegression
+
     fname_type = os.path.split(vol_path)[1]
     pat_id = fname_type.split('.')[0]
     msg = f"Reading file {fname_type}..."
@@ -221,6 +222,7 @@ def plot_img(img_data, traces=None, cmap=None, fovea=None, save_path=None,
     '''
     Helper function to plot the result - plot the image, traces, colourmap, etc.
     '''
+    import matplotlib.pyplot as plt
     img = img_data.copy().astype(np.float64)
     img -= img.min()
     img /= img.max()
@@ -316,6 +318,8 @@ def compute_opticdisc_radius(fovea, od_centre, od_mask):
     """
     Work out optic disc radius in pixels, according to it's position relative to the fovea.
     """
+    from sklearn.linear_model import LinearRegression
+
     # Extract Optic disc mask and acquisition line boundary,
     od_mask_props = measure.regionprops(measure.label(od_mask))[0]
     #od_mask_radius = od_mask_props.axis_minor_length/2 # naive radius, without account for orientation with fovea
@@ -342,21 +346,6 @@ def compute_opticdisc_radius(fovea, od_centre, od_mask):
     return np.round(od_radius).astype(int), plot_info
 
 
-def _process_opticdisc(od_mask):
-    """
-    Work out optic disc radius in pixels, according to it's position relative to the fovea.
-    """
-    # Extract Optic disc radius and OD boundary if detected
-    try:
-        od_mask_props = measure.regionprops(measure.label(od_mask))[0]
-    except:
-        return None, np.zeros_like(od_mask)
-    od_radius = int((od_mask_props.axis_minor_length + od_mask_props.axis_major_length)/4)
-    od_boundary = segmentation.find_boundaries(od_mask)
-
-    return od_radius, od_boundary
-
-
 def normalise(img, 
               minmax_val=(0,1), 
               astyp=np.float64):
@@ -423,6 +412,7 @@ def nested_dict_to_df(values_dict):
 
 def load_annotation(path, key=None, raw=False, binary=False):
     """Load in .nii.gz file and output region and vessel masks"""
+    import SimpleITK as sitk
     
     # Read the .nii image containing thevsegmentations
     sitk_t1 = sitk.ReadImage(path)
@@ -0,0 +1,214 @@
+import os
+import sys
+import argparse
+import threading
+import torch
+import torch.multiprocessing as mp
+
+SCRIPT_PATH = os.path.realpath(os.path.dirname(__file__))
+PACKAGE_PATH = os.path.dirname(SCRIPT_PATH)
+SMAPS_FIELDS = {'Rss': 'rss', 'Pss': 'pss', 'Private_Clean': 'private', 'Private_Dirty': 'private',
+                'Shared_Clean': 'shared', 'Shared_Dirty': 'shared'}
+
+# Session of each worker process, set by _init_worker
+_SESSION = None
+
+
+def memory_usage(pid=None):
+    """
+    Resident (rss), proportional (pss), private and shared memory of a process in MB, from
+    /proc/<pid>/smaps_rollup. Private memory is what each extra worker costs, while shared
+    memory, e.g. model weights, is held once however many workers use it. None if unavailable.
+    """
+    path = f"/proc/{'self' if pid is None else pid}/smaps_rollup"
+    if not os.path.exists(path):
+        return None
+    usage = {'rss': 0, 'pss': 0, 'private': 0, 'shared': 0}
+    with open(path, 'r') as f:
+        for line in f:
+            field = line.split(':')[0]
+            if field in SMAPS_FIELDS:
+                usage[SMAPS_FIELDS[field]] += int(line.split()[1]) / 1024
+    return usage
+
+
+def total_memory():
+    """Physical memory of this machine in MB, None if unavailable"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**20
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def share_weights(model):
+    """
+    Move a segmenter's model weights into shared memory, so that worker processes use the
+    parent's copy rather than their own. Returns the size of the weights shared in MB, 0
+    for models whose weights cannot be shared, e.g. ONNX Runtime sessions.
+    """
+    if not isinstance(model, torch.nn.Module):
+        # Unwrap CompiledModel
+        model = getattr(model, 'model', None)
+    if not isinstance(model, torch.nn.Module):
+        return 0
+    try:
+        model.share_memory()
+    except RuntimeError:
+        # Frozen TorchScript models cannot be moved
+        return 0
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors) / 2**20
+
+
+def _init_worker(session, num_threads):
+    """Hold the parent's session in this worker, limited to num_threads threads for inference"""
+    global _SESSION
+    _SESSION = session
+    torch.set_num_threads(num_threads)
+
+
+def _analyse(task):
+    """Analyse one file with this worker's session, returning its pid and memory afterwards"""
+    path, save_path, scale, location, eye, kwargs = task
+    output = _SESSION.analyse(path, save_path, scale, location, eye, **kwargs)
+    return os.getpid(), memory_usage(), output
+
+
+class WorkerPool:
+    """
+    Analyses files on several processes which share one copy of a Session's segmentation models.
+    The models are loaded once in the parent and their weights moved into shared memory, so
+    each worker only adds the memory it uses to analyse a file, not its own copy of the weights.
+    Workers are forked on Linux, inheriting the session copy-on-write, and spawned elsewhere,
+    receiving the shared weights rather than a copy.
+
+    The memory of each worker is recorded after every file, see memory_report().
+
+    Inputs:
+    -------------------
+    session (Session) : Session with the segmentation models and settings to analyse with.
+
+    num_workers (int) : Number of worker processes, defaults to the number of available cores.
+
+    num_threads (int) : Number of threads each worker uses for inference, defaults to the
+                        available cores divided by num_workers.
+
+    start_method (str) : 'fork' or 'spawn', defaults to 'fork' on Linux and 'spawn' elsewhere.
+    """
+    def __init__(self, session, num_workers=None, num_threads=None, start_method=None):
+        from sloctolyzer.segment import threads
+        n_cores = threads.available_cores()
+        if num_workers is None:
+            num_workers = n_cores
+        if num_threads is None:
+            num_threads = max(1, n_cores // num_workers)
+        if start_method is None:
+            start_method = 'fork' if sys.platform.startswith('linux') else 'spawn'
+        self.num_workers = num_workers
+        self.num_threads = num_threads
+        self.start_method = start_method
+        self.memory = {}
+
+        models = [session.slo_model.model, session.avo_model.model, session.fov_model.model]
+        self.weights_mb = sum(share_weights(model) for model in models)
+        # Started from a new thread, as libgomp hangs in a child forked by a thread which has already
+        # run in parallel, e.g. while loading the session's models
+        ctx = mp.get_context(start_method)
+        pools = []
+        starter = threading.Thread(target=lambda: pools.append(ctx.Pool(num_workers, initializer=_init_worker,
+                                                                        initargs=(session, num_threads))))
+        starter.start()
+        starter.join()
+        self._pool = pools[0]
+
+    def analyse_many(self, paths, save_path=None, scales=None, locations=None, eyes=None, **kwargs):
+        """
+        Analyse a list of image/.vol files across the workers, as Session.analyse_many. Keyword
+        arguments are passed to sloctolyzer.analyse.analyse, verbose defaulting to False.
+
+        Returns a list with the output of analyse() for each path, in order.
+        """
+        N = len(paths)
+        scales = N*[None] if scales is None else scales
+        locations = N*[None] if locations is None else locations
+        eyes = N*[None] if eyes is None else eyes
+        kwargs.setdefault('verbose', False)
+        tasks = [(path, save_path, scale, location, eye, kwargs)
+                 for (path, scale, location, eye) in zip(paths, scales, locations, eyes)]
+
+        outputs = []
+        for pid, usage, output in self._pool.imap(_analyse, tasks):
+            if usage is not None:
+                self.memory.setdefault(pid, []).append(usage)
+            outputs.append(output)
+
+        return outputs
+
+    def memory_report(self, tolerance_mb=50, verbose=True):
+        """
+        Check each worker's resident memory stays flat, i.e. grows by at most tolerance_mb from
+        after its first file to after its last, rather than accumulating copies of the weights
+        or leaking. Also estimates how many workers fit in this machine's memory, from the
+        largest private memory of a worker.
+
+        Returns whether every worker stayed flat, and a dictionary summarising each worker.
+        """
+        summary = {}
+        for pid, usages in self.memory.items():
+            summary[pid] = {'n_files': len(usages),
+                            'rss_first': usages[0]['rss'],
+                            'rss_last': usages[-1]['rss'],
+                            'growth': usages[-1]['rss'] - usages[0]['rss'],
+                            'private': max(usage['private'] for usage in usages),
+                            'shared': usages[-1]['shared']}
+        flat = all(worker['growth'] <= tolerance_mb for worker in summary.values())
+
+        if verbose:
+            print(f"Model weights: {self.weights_mb:.1f} MB, shared by all {self.num_workers} workers.")
+            for pid, worker in summary.items():
+                print(f"    worker {pid}: RSS {worker['rss_first']:.0f} MB after first file, {worker['rss_last']:.0f} MB after last ({worker['growth']:+.0f} MB over {worker['n_files']} files), {worker['private']:.0f} MB private, {worker['shared']:.0f} MB shared.")
+            ram, parent = total_memory(), memory_usage()
+            if len(summary) > 0 and ram is not None and parent is not None:
+                private = max(worker['private'] for worker in summary.values())
+                print(f"    Each extra worker needs ~{private:.0f} MB, so ~{int((ram - parent['rss']) // private)} workers fit in this machine's {ram/1024:.0f} GB.")
+            print(f"RSS per worker {'stayed flat' if flat else f'grew by more than {tolerance_mb} MB'}.")
+
+        return flat, summary
+
+    def close(self):
+        """Wait for the workers to finish and shut them down"""
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(num_workers={self.num_workers}, num_threads={self.num_threads}, start_method={self.start_method})'
+
+
+# Once called from terminal
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyse SLO images on several worker processes sharing one copy of the models, and check each worker's memory stays flat.")
+    parser.add_argument("image_directory", help="Directory of SLO images to analyse.")
+    parser.add_argument("save_directory", nargs="?", default=None, help="Directory to save results to, nothing is saved if not given.")
+    parser.add_argument("--num_workers", type=int, default=None, help="Number of worker processes, defaults to the number of cores.")
+    parser.add_argument("--num_threads", type=int, default=None, help="Threads per worker, defaults to the cores divided by num_workers.")
+    parser.add_argument("--tolerance", type=float, default=50, help="Maximum growth in MB of a worker's RSS over the run.")
+    parser.add_argument("--segment_only", action="store_true", help="Skip feature measurement.")
+    args = parser.parse_args()
+
+    sys.path.append(PACKAGE_PATH)
+    from sloctolyzer.session import Session
+    img_types = (".bmp", ".png", ".tif", ".jpg", ".jpeg")
+    img_list = sorted(os.path.join(args.image_directory, f) for f in os.listdir(args.image_directory)
+                      if f.lower().endswith(img_types))
+    with WorkerPool(Session(verbose=False), args.num_workers, args.num_threads) as pool:
+        pool.analyse_many(img_list, args.save_directory, save_results=args.save_directory is not None,
+                          compute_metrics=not args.segment_only, collate_segmentations=False)
+        flat, _ = pool.memory_report(args.tolerance)
+    if not flat:
+        raise SystemExit(1)